@@ -1,239 +1,218 @@
+import glob
+import hashlib
 import os
-import pandas as pd
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+import click
+from flask import Flask, jsonify, render_template, request, redirect, url_for
+from werkzeug.http import is_resource_modified
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
 import json
+from assets import Assets
+from compression import CompressionMiddleware
+from ladder import TIME_FORMAT, Player, to_timestamp
+from ladder_cache import LadderCache
+from page_cache import PageCache
+from sheets_client import SheetsClient
+import ranking_engine
+from storage import SheetsStorage, SQLiteStorage, StorageUnavailable, VersionConflict, WriteBehindStorage
 
 app = Flask(__name__)
 
-# Define the Google Sheets ID and ranges for each sheet
+# Fingerprinted, precompressed static files (see assets.py), linked with {{ asset_url(name) }}
+assets = Assets()
+app.jinja_env.globals['asset_url'] = assets.url
+
+# Responses smaller than this (in bytes) are not worth compressing
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+
+# Size limit of the cache of compressed responses
+COMPRESSION_CACHE_MAX_BYTES = int(os.getenv('COMPRESSION_CACHE_MAX_BYTES', str(4 * 1024 * 1024)))
+
+# gzip/brotli compression of the pages and JSON responses, as negotiated with the client
+compression = CompressionMiddleware(app.wsgi_app, min_size=COMPRESSION_MIN_SIZE,
+                                    cache_max_bytes=COMPRESSION_CACHE_MAX_BYTES)
+app.wsgi_app = compression
+
+# Define the Google Sheets ID
 SHEET_ID = '1o-RzjCAGVwmZcVg1tSmlKBs2SbUNIBsyE2VFsBwVv0c'
-RANGE_NAME_RANKING = 'Ranking!A1:D'
-RANGE_NAME_MATCHES = 'Matches!A1:F'
+
+# Where the ladder is stored: 'sheets' reads the spreadsheet directly, 'sqlite' keeps it in a local
+# database (LADDER_DB_PATH). Either way, writes are queued locally and sent to the spreadsheet in the
+# background; with 'sheets' the queue lives in LADDER_QUEUE_PATH.
+LADDER_STORAGE = os.getenv('LADDER_STORAGE', 'sheets')
+LADDER_DB_PATH = os.getenv('LADDER_DB_PATH', 'ladder.db')
+LADDER_QUEUE_PATH = os.getenv('LADDER_QUEUE_PATH', 'ladder_queue.db')
+
+# How long (in seconds) read routes may serve the in-memory ladder before it is refreshed
+LADDER_CACHE_TTL = float(os.getenv('LADDER_CACHE_TTL', '30'))
+LADDER_CACHE_MAX_STALE = float(os.getenv('LADDER_CACHE_MAX_STALE', '300'))
+# An expired ladder is only loaded again if the storage version changed, or once it is older than this
+LADDER_CACHE_MAX_AGE = float(os.getenv('LADDER_CACHE_MAX_AGE', '600'))
+
+# Where `flask verify-ranking` keeps the state of its last replay, so the next one only replays new matches
+LADDER_CHECKPOINT_PATH = os.getenv('LADDER_CHECKPOINT_PATH', 'ranking_checkpoint.json')
+
+# How many times a write is retried against reloaded data when another write got there first
+LADDER_WRITE_ATTEMPTS = 5
+
+# Shared caches (e.g. a CDN) may serve read pages for this many seconds; browsers always revalidate
+PAGE_SHARED_MAX_AGE = int(os.getenv('PAGE_SHARED_MAX_AGE', '10'))
+
+# Memory for rendered read pages, kept per ladder version so they are only rendered once
+PAGE_CACHE_MAX_BYTES = int(os.getenv('PAGE_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+
+# Pages rendered ahead of time after every write
+WARM_PAGES = ('/', '/ranking', '/matches')
+
+
+def source_fingerprint():
+    # Hash of the code, templates and built assets, i.e. of everything that shapes a page besides the
+    # ladder: the same on every dyno and after every restart of one build, different for the next one
+    digest = hashlib.sha1()
+    root = os.path.dirname(os.path.abspath(__file__))
+    for pattern in ('*.py', os.path.join('templates', '*.html')):
+        for path in sorted(glob.glob(os.path.join(root, pattern))):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    digest.update(json.dumps(assets.manifest, sort_keys=True).encode())
+    return digest.hexdigest()[:12]
+
+
+# Part of every page ETag, so pages rendered by a previous release are never answered with a 304.
+# SOURCE_VERSION (the commit being deployed) can be set to use that instead.
+RELEASE = os.getenv('SOURCE_VERSION') or source_fingerprint()
+
+# Shown instead of saving a match or player while the spreadsheet can't be reached
+STORAGE_UNAVAILABLE_MESSAGE = "The ladder spreadsheet can't be reached right now, please try again in a few minutes."
+
+# Number of months of match history rendered per page of /matches
+MATCHES_PAGE_MONTHS = 3
 
 # Set up the credentials and Google Sheets API
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-service_account_info = json.loads(os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON'))
-creds = Credentials.from_service_account_info(service_account_info, scopes=SCOPES)
-service = build('sheets', 'v4', credentials=creds)
-sheet = service.spreadsheets()
-
-
-class Player:
-    def __init__(self, name, initial_rank, age, email):
-        self.name = name
-        self.rank = initial_rank  # Rank is stored as an attribute
-        self.age = age
-        self.email = email
-        self.matches = []
-
-    def __str__(self):
-        return f"{self.name} (Rank: {self.rank})"
-
-
-class Match:
-    def __init__(self, player1, player2, result, sets, time, comment="None"):
-        self.player1 = player1
-        self.player2 = player2
-        self.result = result
-        self.sets = sets
-        self.time = time
-        self.comment = comment
-
-    def __str__(self):
-        return f"{self.player1.name} vs {self.player2.name} - Winner: {self.result}, Sets: {self.sets}"
-
-    def to_dict(self):
-        return {
-            "player1": self.player1.name,
-            "player2": self.player2.name,
-            "result": self.result,
-            "sets": self.sets,
-            "time": self.time,
-            "comment": self.comment
-        }
-
-
-class Ladder:
-    def __init__(self, min_rank_difference=6, downrank_rank_difference=3, uprank_rank_difference=3):
-        self.players = []  # The players list is not assumed to be in ranking order.
-        self.matches = []
-        self.min_rank_difference = min_rank_difference
-        self.downrank_rank_difference = downrank_rank_difference
-        self.uprank_rank_difference = uprank_rank_difference
-
-    def add_player(self, player):
-        self.players.append(player)
-
-    def record_match(self, player1, player2, winner, sets, time, comment):
-        if not comment:
-            comment = 'None'
-        match = Match(player1, player2, winner, sets, time, comment)
-        self.matches.append(match)
-
-        # Create a sorted list of players based on their rank attribute (rank 1 is best)
-        sorted_players = sorted(self.players, key=lambda p: p.rank)
-        # Find the indices in the sorted order
-        idx1 = next(i for i, p in enumerate(sorted_players) if p.name == player1.name)
-        idx2 = next(i for i, p in enumerate(sorted_players) if p.name == player2.name)
-
-        # Determine the better ranked (lower rank number) and the worse ranked player.
-        if idx1 < idx2:
-            better = player1
-            worse = player2
-            better_index, worse_index = idx1, idx2
-        else:
-            better = player2
-            worse = player1
-            better_index, worse_index = idx2, idx1
-
-        # If the better ranked player wins, no ranking change is needed.
-        if winner == better:
-            return
 
-        # Upset occurred: the better ranked player lost.
-        rank_diff = worse_index - better_index
-
-        if rank_diff <= self.min_rank_difference:
-            # For a small difference, simply swap the players’ rank values.
-            better.rank, worse.rank = worse.rank, better.rank
-        else:
-            # For a significant upset, adjust rankings:
-            # 1. Determine new positions in the sorted order.
-            #    - The upset winner moves up by uprank_rank_difference positions.
-            #    - The better (losing) player moves down by downrank_rank_difference positions.
-            winner_index = next(i for i, p in enumerate(sorted_players) if p.name == winner.name)
-            new_winner_index = max(0, winner_index - self.uprank_rank_difference)
-            # Remove and reinsert the upset winner.
-            sorted_players.pop(winner_index)
-            sorted_players.insert(new_winner_index, winner)
-
-            # Now, adjust the loser (the originally better player).
-            loser_index = next(i for i, p in enumerate(sorted_players) if p.name == better.name)
-            new_loser_index = min(len(sorted_players) - 1, loser_index + self.downrank_rank_difference)
-            sorted_players.pop(loser_index)
-            sorted_players.insert(new_loser_index, better)
-
-            # Reassign sequential rank numbers (starting at 1) based on new sorted order.
-            for i, player in enumerate(sorted_players):
-                player.rank = i + 1
-
-        # Optionally, update self.players to match the new order.
-        # (This is not strictly necessary since ranking is stored in each player's attribute.)
-        # self.players = sorted_players
-
-    def get_player(self, name):
-        for player in self.players:
-            if player.name == name:
-                return player
-        return None
-
-    def get_ranking(self):
-        # Return players sorted by their rank attribute (lowest rank number first)
-        return sorted(self.players, key=lambda p: p.rank)
-
-    def get_matches(self):
-        return self.matches
-
-
-# Ladder system instance
-ladder = Ladder()
-
-
-def save_to_google_sheets():
-    ranking_data = [['Name', 'Rank', 'Age', 'Email']] + [
-        [p.name, p.rank, p.age, p.email] for p in ladder.players
-    ]
-    matches_data = [['Player 1', 'Player 2', 'Winner', 'Sets', 'Time', 'Comment']] + [
-        [m.player1.name, m.player2.name, m.result.name if isinstance(m.result, Player) else m.result,
-         str(m.sets), str(m.time), m.comment]
-        for m in ladder.matches
-    ]
-
-    sheet.values().update(
-        spreadsheetId=SHEET_ID,
-        range=RANGE_NAME_RANKING,
-        valueInputOption="RAW",
-        body={"values": ranking_data}
-    ).execute()
-    
-    sheet.values().update(
-        spreadsheetId=SHEET_ID,
-        range=RANGE_NAME_MATCHES,
-        valueInputOption="RAW",
-        body={"values": matches_data}
-    ).execute()
-
-
-def load_from_google_sheets():
-    ranking_result = sheet.values().get(spreadsheetId=SHEET_ID, range=RANGE_NAME_RANKING).execute()
-    ranking_values = ranking_result.get('values', [])
-    print("--------")
-    print(ranking_values)
-    print("--------")
-    matches_result = sheet.values().get(spreadsheetId=SHEET_ID, range=RANGE_NAME_MATCHES).execute()
-    matches_values = matches_result.get('values', [])
-
-    ladder.players = []
-    for row in ranking_values[1:]:
-        player = Player(row[0], int(row[1]), int(row[2]), row[3])
-        ladder.add_player(player)
-    # Ensure players are sorted by their rank attribute
-    ladder.players.sort(key=lambda p: p.rank)
-
-    ladder.matches = []
-    for row in matches_values[1:]:
-        player1 = next(p for p in ladder.players if p.name == row[0])
-        player2 = next(p for p in ladder.players if p.name == row[1])
-        winner = row[2]
-        sets = row[3]
-        time = row[4]
-        comment = row[5]
-        match = Match(player1, player2, winner, sets, time, comment)
-        ladder.matches.append(match)
-        
+
+def load_credentials():
+    service_account_info = json.loads(os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON'))
+    return Credentials.from_service_account_info(service_account_info, scopes=SCOPES)
+
+
+# Credentials and the service are set up lazily in each worker process, on the first request
+sheets_client = SheetsClient(load_credentials)
+
+sheets_storage = SheetsStorage(sheets_client, SHEET_ID)
+if LADDER_STORAGE == 'sqlite':
+    storage = SQLiteStorage(LADDER_DB_PATH, sheets=sheets_storage)
+else:
+    storage = WriteBehindStorage(sheets_storage, LADDER_QUEUE_PATH)
+
+
+# Read routes are served from this snapshot; writes load fresh data and publish the result
+ladder_cache = LadderCache(storage.load, ttl=LADDER_CACHE_TTL, max_stale=LADDER_CACHE_MAX_STALE,
+                           check_version=storage.version, max_age=LADDER_CACHE_MAX_AGE,
+                           sequence=storage.sequence)
+
+page_cache = PageCache(PAGE_CACHE_MAX_BYTES)
+
+
+def update_ladder(write):
+    # Optimistic concurrency control. `write(ladder)` applies a change to freshly loaded data and
+    # saves it with `ladder.version`; the storage rejects the save with VersionConflict if anyone
+    # else wrote since that version was loaded, and then the change is applied again to a reloaded
+    # ladder. Concurrent writers never overwrite each other, and nothing is locked across the load.
+    for attempt in range(LADDER_WRITE_ATTEMPTS):
+        ladder = storage.load()
+        try:
+            ladder.version = write(ladder)
+        except VersionConflict:
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))  # Back off so the retries don't collide again
+            continue
+        ladder_cache.put(ladder)
+        threading.Thread(target=warm_pages, daemon=True).start()
+        return ladder
+    raise VersionConflict(f"Gave up after {LADDER_WRITE_ATTEMPTS} conflicting writes")
+
+
+def warm_pages():
+    # Render the most visited pages of the ladder that was just published, so that its first
+    # readers get them straight from the page cache
+    for path in WARM_PAGES:
+        try:
+            with app.test_request_context(path):
+                app.full_dispatch_request()
+        except Exception as e:
+            print(f"Warming {path} failed: {e}")
+
+
+def ladder_page(ladder, render):
+    # Response for a read page showing `ladder`, rendered by `render()`. The ETag only depends on
+    # the release and the ladder snapshot, so a client that already has this version of the page
+    # gets a 304 without anything being rendered. Otherwise the page comes from the page cache,
+    # which only renders it once per ladder snapshot and query string. There is no Last-Modified:
+    # snapshots are published by several processes, and two of them can fall in the same second.
+    etag = f"{RELEASE}-{ladder.fingerprint}"
+    if is_resource_modified(request.environ, etag=etag):
+        key = (request.endpoint, tuple(sorted(request.args.items(multi=True))), ladder.fingerprint)
+        response = app.response_class(page_cache.get(key, render))
+    else:
+        response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = (f'public, max-age=0, s-maxage={PAGE_SHARED_MAX_AGE}, '
+                                         f'stale-while-revalidate={PAGE_SHARED_MAX_AGE}')
+    return response
+
 
 @app.route('/')
 def index():
-    load_from_google_sheets()
-    players = ladder.get_ranking()
-    return render_template('index.html', players=players)
+    ladder = ladder_cache.get()
+    return ladder_page(ladder, lambda: render_template('index.html', players=ladder.get_ranking()))
 
 
 @app.route('/ranking')
 def ranking():
-    load_from_google_sheets()
-    players = ladder.get_ranking()
-    return render_template('ranking.html', players=players)
+    ladder = ladder_cache.get()
+    return ladder_page(ladder, lambda: render_template('ranking.html', players=ladder.get_ranking()))
 
 
 @app.route('/matches')
 def matches():
-    load_from_google_sheets()
-    matches = ladder.get_matches()
+    ladder = ladder_cache.get()
 
-    for match in matches:
-        match.time_obj = datetime.strptime(match.time, '%Y-%m-%d %H:%M:%S')
-        match.formatted_time = match.time_obj.strftime('%Y-%m-%d')
+    # Optional filters: ?player=<name>&start=YYYY-MM-DD&end=YYYY-MM-DD (both dates inclusive)
+    filters = {key: request.args[key] for key in ('player', 'start', 'end') if request.args.get(key)}
+    try:
+        before = request.args.get('before')  # Cursor: only show months older than YYYY-MM
+        before = (int(before[:4]), int(before[5:7])) if before else None
+        since = to_timestamp(datetime.strptime(filters['start'], '%Y-%m-%d')) if 'start' in filters else None
+        until = to_timestamp(datetime.strptime(filters['end'], '%Y-%m-%d') + timedelta(days=1)) if 'end' in filters else None
+    except ValueError:
+        return "Invalid date in match history filters", 400
 
-    matches.sort(key=lambda x: x.time_obj, reverse=True)
+    def render():
+        player_id = None
+        if 'player' in filters:
+            player = ladder.get_player(filters['player'])
+            player_id = player.id if player else -1
 
-    grouped_matches = {}
-    for match in matches:
-        match_month_year = match.time_obj.strftime('%B %Y')
-        if match_month_year not in grouped_matches:
-            grouped_matches[match_month_year] = []
-        grouped_matches[match_month_year].append(match)
+        grouped_matches, next_before = ladder.get_history().page(before, MATCHES_PAGE_MONTHS, player_id, since, until)
+        next_url = None
+        if next_before:
+            next_url = url_for('matches', before='%04d-%02d' % next_before, **filters)
 
-    return render_template('matches.html', grouped_matches=grouped_matches)
+        # "Load more" requests only need the next months, not the whole page around them
+        template = '_match_months.html' if request.args.get('partial') else 'matches.html'
+        return render_template(template, grouped_matches=grouped_matches, next_url=next_url,
+                               players=ladder.get_ranking(), filters=filters)
+
+    return ladder_page(ladder, render)
 
 
 @app.route('/add_match', methods=['GET', 'POST'])
 def add_match():
     error_message = None
-    load_from_google_sheets()
 
     if request.method == 'POST':
         player1_name = request.form['player1']
@@ -242,39 +221,54 @@ def add_match():
         sets = request.form['sets']
         comment = request.form['comment']
 
-        player1 = ladder.get_player(player1_name)
-        player2 = ladder.get_player(player2_name)
-
-        match_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        match_time = datetime.now().replace(microsecond=0)
 
-        try:
+        # Always record against fresh data, never against a cached snapshot
+        def record(ladder):
+            player1 = ladder.get_player(player1_name)
+            player2 = ladder.get_player(player2_name)
             if winner == 'player1':
-                ladder.record_match(player1, player2, player1, sets, match_time, comment)
+                changes = ladder.record_match(player1, player2, player1, sets, match_time, comment)
             else:
-                ladder.record_match(player1, player2, player2, sets, match_time, comment)
+                changes = ladder.record_match(player1, player2, player2, sets, match_time, comment)
+            return storage.save_match(ladder.matches[-1], changes, ladder.version)
 
-            save_to_google_sheets()
+        try:
+            update_ladder(record)
             return redirect(url_for('index'))
         except ValueError as e:
             error_message = str(e)
-    
-    return render_template('add_match.html', players=ladder.players, error=error_message)
+        except VersionConflict:
+            error_message = "Too many matches are being recorded right now, please try again."
+        except StorageUnavailable as e:
+            print(f"Recording a match failed: {e}")
+            error_message = STORAGE_UNAVAILABLE_MESSAGE
 
+    ladder = ladder_cache.get()
+    return render_template('add_match.html', players=ladder.get_ranking(), error=error_message)
 
-@app.route('/filter_players', methods=['POST'])
+
+@app.route('/filter_players', methods=['GET', 'POST'])
 def filter_players():
-    player1_name = request.json.get('player1')
+    # GET /filter_players?player1=<name> can be cached by the browser; POST takes {"player1": <name>}
+    ladder = ladder_cache.get()
+    if request.method == 'POST':
+        player1_name = request.json.get('player1')
+    else:
+        player1_name = request.args.get('player1')
     player1 = ladder.get_player(player1_name)
     
     if not player1:
         return {"error": "Player not found"}, 400
 
-    eligible_players = [
-        player.name for player in ladder.players
-        if abs(player.rank - player1.rank) <= ladder.min_rank_difference and player != player1
-    ]
+    # Computed once per ladder snapshot and player
+    eligible_players = [player.name for player in ladder.opponents(player1)]
 
-    return {"players": eligible_players}
+    response = jsonify(players=eligible_players)
+    response.cache_control.public = True
+    response.cache_control.max_age = int(LADDER_CACHE_TTL)
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @app.route('/add_player')
@@ -284,21 +278,163 @@ def add_player_form():
 
 @app.route('/add_player', methods=['POST'])
 def add_player():
-    load_from_google_sheets()
-
     name = request.form['name']
     age = int(request.form['age'])
     email = request.form['email']
 
-    new_rank = len(ladder.players) + 1
-    new_player = Player(name, new_rank, age, email)
-    ladder.add_player(new_player)
-
-    save_to_google_sheets()
+    def add(ladder):
+        # Checked against fresh data, so a form submitted twice doesn't add the player twice
+        if ladder.get_player(name) is not None:
+            raise ValueError(f"A player named {name} already exists.")
+        new_rank = len(ladder.players) + 1
+        new_player = Player(name, new_rank, age, email)
+        ladder.add_player(new_player)
+        return storage.add_player(new_player, ladder.version)
+
+    try:
+        update_ladder(add)
+    except ValueError as e:
+        return render_template('add_player.html', error=str(e))
+    except VersionConflict:
+        return render_template('add_player.html', error="The ladder is being updated by others right now, please try again.")
+    except StorageUnavailable as e:
+        print(f"Adding a player failed: {e}")
+        return render_template('add_player.html', error=STORAGE_UNAVAILABLE_MESSAGE)
 
     return redirect(url_for('index'))
 
 
+@app.cli.command('compact-sheets')
+def compact_sheets():
+    """Rewrite the Ranking and Matches sheets in full from their current contents."""
+    ladder = update_ladder(storage.compact)  # Redone on fresh data if anything is written meanwhile
+    print(f"Rewrote {len(ladder.players)} players and {len(ladder.matches)} matches.")
+
+
+@app.cli.command('export-excel')
+@click.argument('path', default='ladder_data.xlsx')
+def export_excel(path):
+    """Save the ladder to an Excel workbook (Ranking and Matches sheets)."""
+    import excel_io  # Imported here so the web app never loads openpyxl
+
+    ladder = storage.load()
+    excel_io.write_ladder(ladder, path)
+    print(f"Exported {len(ladder.players)} players and {len(ladder.matches)} matches to {path}.")
+
+
+@app.cli.command('import-excel')
+@click.argument('path', default='ladder_data.xlsx')
+def import_excel(path):
+    """Replace the ladder with the contents of an Excel workbook (Ranking and Matches sheets)."""
+    import excel_io  # Imported here so the web app never loads openpyxl
+
+    ladder = excel_io.read_ladder(path)
+    storage.replace(ladder)
+    ladder_cache.invalidate()
+    print(f"Imported {len(ladder.players)} players and {len(ladder.matches)} matches from {path}.")
+
+
+@app.cli.command('verify-ranking')
+@click.option('--baseline', 'save_baseline', is_flag=True,
+              help="Trust the stored ranking as it is now; later runs replay the matches recorded after it.")
+@click.option('--reset', is_flag=True, help="Replay from the baseline instead of starting from the last checkpoint.")
+@click.option('--apply', 'apply_ranks', is_flag=True, help="Replace the stored ranks with the replayed ones.")
+def verify_ranking(save_baseline, reset, apply_ranks):
+    """Replay the match history through the ladder rules and compare the result with the stored ranks."""
+    ladder = storage.load()
+    if save_baseline:
+        ranking_engine.save_baseline(ladder, LADDER_CHECKPOINT_PATH)
+        print(f"Saved the ranking after {len(ladder.matches)} matches as the baseline in {LADDER_CHECKPOINT_PATH}.")
+        return
+
+    try:
+        engine, mismatches, unresolved = ranking_engine.verify(ladder, LADDER_CHECKPOINT_PATH, reset)
+    except ranking_engine.MissingBaseline as e:
+        print(f"{e}. Run `flask verify-ranking --baseline` while the stored ranking is known to be right.")
+        return
+    print(f"Replayed {len(ladder.matches)} matches: {len(mismatches)} of {len(ladder.players)} ranks differ.")
+    for player, stored_rank, replayed_rank in mismatches:
+        print(f"  {player.name}: stored {stored_rank}, replayed {replayed_rank}")
+    if unresolved:
+        print("Matches that could not be replayed, their winner is not one of their players:")
+        for i in unresolved:
+            match = ladder.matches[i]
+            print(f"  {match.time.strftime(TIME_FORMAT)} {match.player1.name} vs {match.player2.name}, winner {match.result!r}")
+
+    if mismatches and apply_ranks:
+        if unresolved:
+            print("Not saving the replayed ranks, they miss the matches that could not be replayed.")
+            return
+
+        # Replayed again on the ladder the ranks are saved to, with a compare-and-swap on its
+        # version like any other write, so matches recorded meanwhile are never overwritten
+        def apply(ladder):
+            engine, _, unresolved = ranking_engine.verify(ladder, LADDER_CHECKPOINT_PATH)
+            if unresolved:
+                raise ValueError("New matches could not be replayed")
+            changes = ladder.set_ranks(engine.ranks())
+            return storage.save_ranks(changes, ladder.version)
+
+        update_ladder(apply)
+        print("Saved the replayed ranks.")
+
+
+@app.cli.command('simulate-rules')
+@click.option('--min-diff', default='4-8', help="Values of min_rank_difference, e.g. 4-8 or 4,6,8.")
+@click.option('--down', default='1-5', help="Values of downrank_rank_difference.")
+@click.option('--up', default='1-5', help="Values of uprank_rank_difference.")
+@click.option('--top', default=3, help="Number of players shown from each simulated ranking.")
+@click.option('--processes', type=int, default=None, help="Worker processes (default: one per CPU for large sweeps).")
+@click.option('--json', 'as_json', is_flag=True, help="Print all results, with full standings, as JSON.")
+def simulate_rules(min_diff, down, up, top, processes, as_json):
+    """Replay the match history under other ladder rules and compare volatility and standings."""
+    import simulator  # Imported here so the web app never loads the process pool machinery
+
+    ladder = storage.load()
+    try:
+        baseline = ranking_engine.load_baseline(ladder, LADDER_CHECKPOINT_PATH)
+    except ranking_engine.MissingBaseline as e:
+        print(f"{e}. Run `flask verify-ranking --baseline` while the stored ranking is known to be right.")
+        return
+    rules = simulator.rule_grid(simulator.parse_values(min_diff), simulator.parse_values(down),
+                                simulator.parse_values(up))
+    started = time.perf_counter()
+    results = simulator.simulate(ladder, rules, baseline, processes)
+    elapsed = time.perf_counter() - started
+
+    if as_json:
+        print(json.dumps([dict(result, rules=result['rules']._asdict(),
+                               standings=[player.name for player in result['standings']])
+                          for result in results], indent=2))
+        return
+
+    current = simulator.ladder_rules(ladder)
+    print(f"Replayed {len(ladder.matches) - baseline.matches} matches since the baseline under {len(rules)} "
+          f"rule sets in {elapsed:.2f}s (window, down, up; * = current rules).")
+    unresolved = ladder.matches.unresolved(baseline.matches)
+    if unresolved:
+        print(f"Skipped {len(unresolved)} matches whose winner is not one of their players "
+              f"(listed by `flask verify-ranking`).")
+    print(f"{'rules':>10} {'changes':>8} {'moves/match':>12} {'distance':>9}  standings")
+    for result in sorted(results, key=lambda r: r['moves_per_match']):
+        rule = result['rules']
+        label = ('*' if rule == current else '') + f"{rule[0]},{rule[1]},{rule[2]}"
+        standings = ', '.join(player.name for player in result['standings'][:top])
+        print(f"{label:>10} {result['changes']:>8} {result['moves_per_match']:>12.2f} {result['distance']:>9}  {standings}")
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    return assets.send(filename)
+
+
+@app.route('/stats')
+def stats():
+    return {"ladder_cache": ladder_cache.stats(), "page_cache": page_cache.stats(),
+            "compression": compression.stats(), "storage": storage.stats(),
+            "sheets_client": sheets_client.stats()}
+
+
 if __name__ == '__main__':
-    load_from_google_sheets()
+    ladder_cache.get()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,109 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import abort, request, send_from_directory, url_for
+
+try:
+    import brotli  # Optional: without it only gzip variants are built
+except ImportError:
+    brotli = None
+
+# Static assets are built into static/dist as fingerprinted copies (style.3f2a9c81d0e4.css), so
+# they can be cached forever, each next to precompressed .gz and .br variants. `python assets.py`
+# builds them (bin/post_compile runs it on deploy); the app rebuilds them on start if they are
+# missing or out of date, e.g. while developing.
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+BUILD_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = 'manifest.json'  # Source name -> fingerprinted name, in BUILD_DIR
+
+# Files of STATIC_DIR that are served as built assets
+SOURCES = ['style.css']
+
+# Fingerprinted files never change, so browsers may keep them for a year without revalidating
+MAX_AGE = 365 * 24 * 60 * 60
+
+
+def fingerprinted_name(name, data):
+    root, ext = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def build(static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+    os.makedirs(build_dir, exist_ok=True)
+    manifest = {}
+    for name in SOURCES:
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            data = f.read()
+        built = fingerprinted_name(name, data)
+        path = os.path.join(build_dir, built)
+        _write(path, data)
+        _write(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write(path + '.br', brotli.compress(data, quality=11))
+        manifest[name] = built
+    _write(os.path.join(build_dir, MANIFEST), json.dumps(manifest, indent=2).encode())
+    return manifest
+
+
+def load_manifest(static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+    # The manifest of the last build, or None when it is missing or a source has changed since
+    try:
+        with open(os.path.join(build_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+        for name in SOURCES:
+            with open(os.path.join(static_dir, name), 'rb') as f:
+                if manifest.get(name) != fingerprinted_name(name, f.read()):
+                    return None
+            if not os.path.exists(os.path.join(build_dir, manifest[name])):
+                return None
+    except (OSError, ValueError):
+        return None
+    return manifest
+
+
+class Assets:
+    # Serves the built assets of a Flask app: `url(name)` for templates, and `send(filename)` for
+    # the route that serves them.
+    def __init__(self, endpoint='asset', static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+        self.endpoint = endpoint
+        self.build_dir = build_dir
+        self.manifest = load_manifest(static_dir, build_dir) or build(static_dir, build_dir)
+        self._files = set(self.manifest.values())
+
+    def url(self, name):
+        return url_for(self.endpoint, filename=self.manifest[name])
+
+    def send(self, filename):
+        # The precompressed variant the client accepts (brotli first), or the file itself
+        if filename not in self._files:
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0]
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if request.accept_encodings.quality(candidate) > 0 and os.path.exists(os.path.join(self.build_dir, filename + suffix)):
+                encoding = candidate
+                filename += suffix
+                break
+
+        response = send_from_directory(self.build_dir, filename, mimetype=mimetype, max_age=MAX_AGE)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+def _write(path, data):
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    for source, built in build().items():
+        print(f"{source} -> {os.path.relpath(os.path.join(BUILD_DIR, built))}")
@@ -0,0 +1,146 @@
+import gzip
+import hashlib
+
+from werkzeug.http import parse_accept_header
+
+from page_cache import PageCache
+
+try:
+    import brotli  # Optional: without it responses are only gzipped
+except ImportError:
+    brotli = None
+
+# WSGI middleware that compresses text responses (HTML pages, JSON) with the best encoding the
+# client accepts. Pages only change with the ladder, so the same bodies are sent over and over:
+# compressed bodies are kept in an LRU cache keyed by a hash of the uncompressed body, and an
+# unchanged page is only compressed once per encoding.
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript',
+    'application/json', 'application/javascript', 'image/svg+xml',
+}
+
+# Encodings in order of preference when the client accepts several equally
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def compress(data, encoding):
+    # Moderate levels: a miss compresses while the client waits, and the result is cached anyway
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+class CompressionMiddleware:
+    # Wraps a WSGI app (app.wsgi_app = CompressionMiddleware(app.wsgi_app)). Responses smaller than
+    # `min_size` bytes, of other types, with a Content-Encoding of their own (like the precompressed
+    # static assets), without a Content-Length (streamed), or marked no-transform pass through as is.
+    def __init__(self, app, min_size=1024, cache_max_bytes=4 * 1024 * 1024):
+        self.app = app
+        self.min_size = min_size
+        self.cache = PageCache(cache_max_bytes)
+
+    def __call__(self, environ, start_response):
+        encoding = self._negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        response = []
+
+        def capture(status, headers, exc_info=None):
+            # The real response only starts once the encoding is decided
+            response[:] = [status, list(headers), exc_info]
+            return _write_unsupported
+
+        app_iter = self.app(environ, capture)
+        if not response:  # The app only starts its response once iterated
+            app_iter = [_read(app_iter)]
+        status, headers, exc_info = response
+        code = int(status.split(None, 1)[0])
+
+        if code == 304:
+            # Same ETag as a compressed 200 would have had (see below)
+            if encoding is not None:
+                headers = _weaken_etag(headers)
+            start_response(status, headers, exc_info)
+            return app_iter
+
+        length = self._length(headers)
+        if (environ.get('REQUEST_METHOD') == 'HEAD' or code < 200 or code in (204, 206)
+                or not self._compressible(headers) or length is None or length < self.min_size):
+            start_response(status, headers, exc_info)
+            return app_iter
+
+        headers = _add_vary(headers)
+        if encoding is None:
+            start_response(status, headers, exc_info)
+            return app_iter
+
+        body = _read(app_iter)
+        key = (encoding, hashlib.sha1(body).digest())
+        compressed = self.cache.get(key, lambda: compress(body, encoding))
+
+        # The compressed body is a different representation of the same resource: it keeps the
+        # ETag, but as a weak one, which conditional requests still match
+        headers = [(name, value) for name, value in _weaken_etag(headers) if name.lower() != 'content-length']
+        headers += [('Content-Encoding', encoding), ('Content-Length', str(len(compressed)))]
+        start_response(status, headers, exc_info)
+        return [compressed]
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['min_size'] = self.min_size
+        stats['encodings'] = ENCODINGS
+        return stats
+
+    def _negotiate(self, accept_encoding):
+        # The accepted encoding with the highest quality, or None to send the body as is
+        accept = parse_accept_header(accept_encoding)
+        best, best_quality = None, 0
+        for encoding in ENCODINGS:
+            quality = accept.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def _compressible(self, headers):
+        content_type = cache_control = ''
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+            if name == 'content-type':
+                content_type = value.split(';', 1)[0].strip().lower()
+            elif name == 'cache-control':
+                cache_control = value.lower()
+        return content_type in COMPRESSIBLE_TYPES and 'no-transform' not in cache_control
+
+    def _length(self, headers):
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                return int(value)
+        return None
+
+
+def _write_unsupported(data):
+    raise RuntimeError("CompressionMiddleware doesn't support the WSGI write() callable")
+
+
+def _read(app_iter):
+    try:
+        return b''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def _add_vary(headers):
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == 'vary':
+            if 'accept-encoding' not in value.lower() and value.strip() != '*':
+                headers = list(headers)
+                headers[i] = (name, f"{value}, Accept-Encoding")
+            return headers
+    return list(headers) + [('Vary', 'Accept-Encoding')]
+
+
+def _weaken_etag(headers):
+    return [(name, f"W/{value}" if name.lower() == 'etag' and not value.startswith('W/') else value)
+            for name, value in headers]
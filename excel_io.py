@@ -0,0 +1,64 @@
+from datetime import datetime
+
+from openpyxl import Workbook, load_workbook
+
+from ladder import TIME_FORMAT
+from storage import RANKING_HEADER, MATCHES_HEADER, build_ladder, match_to_row, player_to_row
+
+# Import and export of the ladder as an Excel workbook laid out like the spreadsheet (and the old
+# ladder_data.xlsx): a "Ranking" sheet (Name, Rank, Age, Email) and a "Matches" sheet (Player 1,
+# Player 2, Winner, Sets, Time, Comment). Only the `flask import-excel` / `export-excel` commands
+# import this module, so openpyxl is never loaded by the web app itself. Workbooks are streamed
+# row by row (read-only / write-only mode) instead of being loaded into memory as a whole.
+
+RANKING_SHEET = 'Ranking'
+MATCHES_SHEET = 'Matches'
+
+
+def read_ladder(path):
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        player_rows = [
+            _cells(row, 4) + [row_number]
+            for row_number, row in _data_rows(workbook[RANKING_SHEET])
+        ]
+        match_rows = [_cells(row, 6) for _, row in _data_rows(workbook[MATCHES_SHEET])]
+    finally:
+        workbook.close()  # Read-only workbooks keep the file open until closed
+    return build_ladder(player_rows, match_rows)
+
+
+def write_ladder(ladder, path):
+    workbook = Workbook(write_only=True)
+    ranking = workbook.create_sheet(RANKING_SHEET)
+    ranking.append(RANKING_HEADER)
+    for player in ladder.get_ranking():
+        ranking.append(player_to_row(player))
+
+    matches = workbook.create_sheet(MATCHES_SHEET)
+    matches.append(MATCHES_HEADER)
+    for match in ladder.matches:
+        matches.append(match_to_row(match))
+    workbook.save(path)
+
+
+def _data_rows(sheet):
+    # (row number, values) of every non-empty row below the header
+    for row_number, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
+        if any(value is not None and value != '' for value in row):
+            yield row_number, row
+
+
+def _cells(row, width):
+    # The first `width` cells as the strings the spreadsheet would return, padded with ''
+    cells = []
+    for value in list(row[:width]) + [None] * (width - len(row)):
+        if value is None:
+            cells.append('')
+        elif isinstance(value, datetime):
+            cells.append(value.strftime(TIME_FORMAT))
+        elif isinstance(value, float) and value.is_integer():
+            cells.append(str(int(value)))
+        else:
+            cells.append(str(value))
+    return cells
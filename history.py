@@ -0,0 +1,117 @@
+import threading
+from bisect import insort
+from datetime import datetime
+
+
+class MatchHistory:
+    # Index over a MatchLog that keeps matches sorted by time (newest first) and grouped by month.
+    # Matches appended to the log are indexed on the next access, without re-sorting what is already
+    # there. Every write publishes a freshly loaded ladder, so a new snapshot's index starts from the
+    # previous snapshot's (`base`) when its log continues that one, and only indexes the new matches.
+    def __init__(self, matches, base=None):
+        self._matches = matches
+        self._lock = threading.Lock()
+        self._indexed = 0
+        self._months = []  # Sorted (-year, -month) keys, i.e. newest month first
+        self._buckets = {}  # (year, month) -> sorted list of (-timestamp, match index)
+        self._views = {}  # (year, month) -> list of Match, built on first read
+        self._shared = set()  # Months whose bucket is still the list of `base`, copied before changing
+        if base is not None:
+            self._extend(base)
+
+    def __len__(self):
+        return len(self._matches)
+
+    def months(self):
+        # [(year, month), ...] newest first
+        self._sync()
+        return [(-year, -month) for year, month in self._months]
+
+    def month(self, year, month):
+        # Matches of one month, newest first
+        self._sync()
+        key = (year, month)
+        views = self._views.get(key)
+        if views is None:
+            views = [self._matches[i] for _, i in self._buckets.get(key, [])]
+            self._views[key] = views
+        return views
+
+    def page(self, before=None, limit=3, player_id=None, since=None, until=None):
+        # One page of history: up to `limit` non-empty months older than the `before` (year, month)
+        # cursor, keeping only matches of `player_id` and with since <= timestamp < until.
+        # Returns ({'February 2025': [Match, ...], ...}, cursor of the next page or None).
+        self._sync()
+        filtered = player_id is not None or since is not None or until is not None
+        grouped = {}
+        last_key = None
+        for key in self.months():
+            if before is not None and key >= before:
+                continue
+            indices = self._select(key, player_id, since, until)
+            if not indices:
+                continue
+            if len(grouped) == limit:
+                return grouped, last_key
+            if filtered:
+                grouped[month_label(*key)] = [self._matches[i] for i in indices]
+            else:
+                grouped[month_label(*key)] = self.month(*key)
+            last_key = key
+        return grouped, None
+
+    def _select(self, key, player_id, since, until):
+        bucket = self._buckets[key]
+        if player_id is None and since is None and until is None:
+            return bucket
+        # Skip the whole month when it lies outside the requested range
+        if since is not None and -bucket[0][0] < since:
+            return []
+        if until is not None and -bucket[-1][0] >= until:
+            return []
+        return [
+            i for neg_timestamp, i in bucket
+            if (since is None or -neg_timestamp >= since)
+            and (until is None or -neg_timestamp < until)
+            and (player_id is None or player_id in self._matches.players(i))
+        ]
+
+    def _sync(self):
+        if self._indexed == len(self._matches):
+            return
+        with self._lock:
+            for i in range(self._indexed, len(self._matches)):
+                self._add(i)
+            self._indexed = len(self._matches)
+
+    def _extend(self, base):
+        # Start from the index of `base` if its matches are the first ones of this log. Buckets only
+        # hold timestamps and match indexes, so equal timestamps are all they need; they are shared
+        # until a new match lands in them. Views hold the other ladder's players and are not reused.
+        base._sync()
+        count = base._indexed
+        timestamps = self._matches.timestamps()
+        if count > len(timestamps) or timestamps[:count] != base._matches.timestamps()[:count]:
+            return
+        self._months = list(base._months)
+        self._buckets = dict(base._buckets)
+        self._shared = set(self._buckets)
+        self._indexed = count
+
+    def _add(self, i):
+        time = self._matches.time(i)
+        key = (time.year, time.month)
+        bucket = self._buckets.get(key)
+        if key in self._shared:
+            bucket = self._buckets[key] = list(bucket)
+            self._shared.discard(key)
+        if bucket is None:
+            bucket = self._buckets[key] = []
+            insort(self._months, (-time.year, -time.month))
+        # Ties keep the order in which the matches were recorded
+        insort(bucket, (-self._matches.timestamp(i), i))
+        self._views.pop(key, None)
+
+
+def month_label(year, month):
+    return datetime(year, month, 1).strftime('%B %Y')
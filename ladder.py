@@ -0,0 +1,362 @@
+import hashlib
+import json
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from history import MatchHistory
+
+
+# Format of match timestamps in the Matches sheet
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+_EPOCH = datetime(1970, 1, 1)
+
+
+class Player:
+    __slots__ = ('id', 'name', 'rank', 'age', 'email', 'row')
+
+    def __init__(self, name, initial_rank, age, email, row=None):
+        self.id = None  # Position of the player in Ladder.players, assigned by Ladder.add_player
+        self.name = name
+        self.rank = initial_rank  # Rank is stored as an attribute
+        self.age = age
+        self.email = email
+        self.row = row  # Row of the player in the Ranking sheet (None until it has been written)
+
+    def __str__(self):
+        return f"{self.name} (Rank: {self.rank})"
+
+
+class Match:
+    # Lightweight view of one match. Ladders store matches column-wise in a MatchLog,
+    # and hand out Match objects when they are read.
+    __slots__ = ('player1', 'player2', 'result', 'sets', 'time', 'comment')
+
+    def __init__(self, player1, player2, result, sets, time, comment="None"):
+        self.player1 = player1
+        self.player2 = player2
+        self.result = result
+        self.sets = sets
+        self.time = time  # datetime
+        self.comment = comment
+
+    def __str__(self):
+        return f"{self.player1.name} vs {self.player2.name} - Winner: {self.result}, Sets: {self.sets}"
+
+    def to_dict(self):
+        return {
+            "player1": self.player1.name,
+            "player2": self.player2.name,
+            "result": self.result.name if isinstance(self.result, Player) else self.result,
+            "sets": self.sets,
+            "time": self.time.strftime(TIME_FORMAT),
+            "comment": self.comment
+        }
+
+
+class MatchLog:
+    # Column-per-field storage for the match history. Players are stored by id and times as
+    # integer seconds, so a long history costs a few arrays instead of one object per match.
+    def __init__(self, players):
+        self._players = players  # Ladder.players, indexed by Player.id
+        self._player1 = array('i')
+        self._player2 = array('i')
+        self._winner = array('i')  # Player id, or -1 when the winner is not one of the two players
+        self._timestamp = array('q')
+        self._sets = []
+        self._comment = []
+        self._winner_text = {}  # Raw winner value, for the matches where it is not just the winner's name
+
+    def __len__(self):
+        return len(self._timestamp)
+
+    def __iter__(self):
+        for i in range(len(self._timestamp)):
+            yield self._match(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._match(i) for i in range(*index.indices(len(self._timestamp)))]
+        if index < 0:
+            index += len(self._timestamp)
+        if not 0 <= index < len(self._timestamp):
+            raise IndexError('match index out of range')
+        return self._match(index)
+
+    def append(self, match):
+        i = len(self._timestamp)
+        winner = match.result
+        if isinstance(winner, Player):
+            winner_id = winner.id
+        elif winner == match.player1.name:
+            winner_id = match.player1.id
+        elif winner == match.player2.name:
+            winner_id = match.player2.id
+        else:
+            # Older versions of the app saved the winner as str(Player), e.g. "Cano Ramos (Rank: 1)".
+            # The text is kept as it is, but the match is still credited to that player.
+            winner_id = legacy_winner_id(winner, match.player1, match.player2)
+            self._winner_text[i] = winner
+        self._winner.append(winner_id)
+        self._player1.append(match.player1.id)
+        self._player2.append(match.player2.id)
+        self._timestamp.append(to_timestamp(match.time))
+        self._sets.append(match.sets)
+        self._comment.append(match.comment)
+
+    def timestamp(self, index):
+        return self._timestamp[index]
+
+    def time(self, index):
+        return from_timestamp(self._timestamp[index])
+
+    def players(self, index):
+        # Ids of the two players of a match
+        return self._player1[index], self._player2[index]
+
+    def columns(self):
+        # The (player1, player2, winner) id arrays, for code that scans the whole log at once
+        return self._player1, self._player2, self._winner
+
+    def timestamps(self):
+        return self._timestamp
+
+    def update_digest(self, digest):
+        # Feed the whole log to a hashlib object
+        for column in (self._player1, self._player2, self._winner, self._timestamp):
+            digest.update(column.tobytes())
+        digest.update(json.dumps([self._sets, self._comment, sorted(self._winner_text.items())], default=str).encode())
+
+    def unresolved(self, start=0):
+        # Indexes of the matches from `start` on whose winner is not one of their players
+        return [i for i in range(start, len(self._winner)) if self._winner[i] < 0]
+
+    def _match(self, i):
+        winner = self._winner[i]
+        return Match(
+            self._players[self._player1[i]],
+            self._players[self._player2[i]],
+            self._winner_text[i] if i in self._winner_text else self._players[winner].name,
+            self._sets[i],
+            from_timestamp(self._timestamp[i]),
+            self._comment[i]
+        )
+
+
+def legacy_winner_id(winner, player1, player2):
+    # Id of the player a "<name> (Rank: <rank>)" winner value names, -1 for anything else
+    if isinstance(winner, str) and winner.endswith(')'):
+        for player in (player1, player2):
+            if winner.startswith(f"{player.name} (Rank: "):
+                return player.id
+    return -1
+
+
+def to_timestamp(time):
+    return int((time - _EPOCH).total_seconds())
+
+
+def from_timestamp(timestamp):
+    return _EPOCH + timedelta(seconds=timestamp)
+
+
+# A single rank movement produced by Ladder.record_match
+RankChange = namedtuple('RankChange', ['player', 'old_rank', 'new_rank'])
+
+
+class Ladder:
+    def __init__(self, min_rank_difference=6, downrank_rank_difference=3, uprank_rank_difference=3):
+        self.players = []  # The players list is not assumed to be in ranking order.
+        self.matches = MatchLog(self.players)
+        self.min_rank_difference = min_rank_difference
+        self.downrank_rank_difference = downrank_rank_difference
+        self.uprank_rank_difference = uprank_rank_difference
+        # Indexes kept in sync with `players`: lookup by name, and the players in ranking order.
+        self._players_by_name = {}
+        self._ranked = []
+        self._contiguous = None  # Whether the ranks are exactly 1..n, None until checked
+        self._history = None
+        self.version = None  # Version of the storage this ladder was loaded from, if it has one
+        self.frozen = False  # See freeze()
+
+    def freeze(self, previous=None):
+        # Makes this ladder a read-only snapshot, which any number of threads can then read without
+        # locking. Everything readers would otherwise build lazily is built now; changes must be
+        # made to a freshly loaded ladder, which is published as a new snapshot in turn. `previous`
+        # is the snapshot this one replaces, whose match history index is extended when possible.
+        if not self.frozen:
+            if previous is not None and previous.frozen and self._history is None:
+                self._history = MatchHistory(self.matches, previous.get_history())
+            self.get_history().months()
+            self._ranking = tuple(self._ranked)
+            self._ranks = array('i', [player.rank for player in self._ranking])
+            self._opponents = {}  # Player name -> opponents(), filled on first request
+            self.fingerprint = self._fingerprint()
+            self.frozen = True
+        return self
+
+    def add_player(self, player):
+        self._check_mutable()
+        player.id = len(self.players)
+        self.players.append(player)
+        self._players_by_name.setdefault(player.name, player)  # With duplicate names the first one wins
+        self._contiguous = None
+        # Insert after any player with the same or a better rank
+        lo, hi = 0, len(self._ranked)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._ranked[mid].rank <= player.rank:
+                lo = mid + 1
+            else:
+                hi = mid
+        self._ranked.insert(lo, player)
+
+    def record_match(self, player1, player2, winner, sets, time, comment):
+        # Returns the list of RankChange caused by the match (empty if the ranking is unchanged).
+        self._check_mutable()
+        if not comment:
+            comment = 'None'
+        match = Match(player1, player2, winner, sets, time, comment)
+        self.matches.append(match)
+
+        # Find the positions of both players in the ranking order
+        idx1 = self._position(player1)
+        idx2 = self._position(player2)
+
+        # Determine the better ranked (lower rank number) and the worse ranked player.
+        if idx1 < idx2:
+            better = player1
+            worse = player2
+            better_index, worse_index = idx1, idx2
+        else:
+            better = player2
+            worse = player1
+            better_index, worse_index = idx2, idx1
+
+        # If the better ranked player wins, no ranking change is needed.
+        if winner == better:
+            return []
+
+        # Upset occurred: the better ranked player lost.
+        rank_diff = worse_index - better_index
+
+        if rank_diff <= self.min_rank_difference:
+            # For a small difference, simply swap the players’ rank values (and positions).
+            better.rank, worse.rank = worse.rank, better.rank
+            self._ranked[better_index], self._ranked[worse_index] = worse, better
+            return [
+                RankChange(better, worse.rank, better.rank),
+                RankChange(worse, better.rank, worse.rank),
+            ]
+
+        # For a significant upset, adjust rankings. With the usual 1..n ranks only the positions
+        # between the two moves can change; if the stored ranks have gaps or duplicates (e.g. after
+        # manual edits of the sheet) the whole ladder is renumbered, which makes them 1..n again.
+        # Swaps and renumbering keep ranks 1..n, so they are only checked again after add_player.
+        if self._contiguous is None:
+            self._contiguous = all(player.rank == i + 1 for i, player in enumerate(self._ranked))
+        contiguous = self._contiguous
+
+        # 1. The upset winner moves up by uprank_rank_difference positions.
+        new_winner_index = max(0, worse_index - self.uprank_rank_difference)
+        self._ranked.pop(worse_index)
+        self._ranked.insert(new_winner_index, worse)
+
+        # 2. The better (losing) player moves down by downrank_rank_difference positions.
+        loser_index = better_index + 1 if new_winner_index <= better_index else better_index
+        new_loser_index = min(len(self._ranked) - 1, loser_index + self.downrank_rank_difference)
+        self._ranked.pop(loser_index)
+        self._ranked.insert(new_loser_index, better)
+
+        # 3. Reassign sequential rank numbers (starting at 1) based on the new order.
+        if contiguous:
+            start = min(new_winner_index, better_index)
+            stop = max(worse_index, new_loser_index) + 1
+        else:
+            start, stop = 0, len(self._ranked)
+            self._contiguous = True
+
+        changes = []
+        for i in range(start, stop):
+            player = self._ranked[i]
+            if player.rank != i + 1:
+                changes.append(RankChange(player, player.rank, i + 1))
+                player.rank = i + 1
+        return changes
+
+    def set_ranks(self, ranks):
+        # Give every player the rank in `ranks` (indexed by player id), e.g. ranks recomputed by the
+        # RankingEngine. Returns the list of RankChange.
+        self._check_mutable()
+        changes = []
+        for player in self.players:
+            if player.rank != ranks[player.id]:
+                changes.append(RankChange(player, player.rank, ranks[player.id]))
+                player.rank = ranks[player.id]
+        self._ranked.sort(key=lambda player: player.rank)
+        self._contiguous = None
+        return changes
+
+    def get_player(self, name):
+        return self._players_by_name.get(name)
+
+    def get_ranking(self):
+        # Return players sorted by their rank attribute (lowest rank number first). Snapshots share
+        # one read-only tuple, other ladders return a copy that is safe to keep while they change.
+        if self.frozen:
+            return self._ranking
+        return list(self._ranked)
+
+    def opponents(self, player):
+        # Players `player` may challenge: everyone within min_rank_difference ranks, best first.
+        # The ranking is sorted by rank, so they are a contiguous slice found by binary search.
+        if self.frozen:
+            opponents = self._opponents.get(player.name)
+            if opponents is not None:
+                return opponents
+            ranking, ranks = self._ranking, self._ranks
+        else:
+            ranking = self._ranked
+            ranks = [p.rank for p in ranking]
+
+        start = bisect_left(ranks, player.rank - self.min_rank_difference)
+        stop = bisect_right(ranks, player.rank + self.min_rank_difference)
+        opponents = tuple(p for p in ranking[start:stop] if p is not player)
+        if self.frozen:
+            self._opponents[player.name] = opponents
+        return opponents
+
+    def get_matches(self):
+        return self.matches
+
+    def get_history(self):
+        # Time-ordered, month-grouped view of the matches, built once per ladder
+        if self._history is None:
+            self._history = MatchHistory(self.matches)
+        return self._history
+
+    def _fingerprint(self):
+        # Hash of everything pages show about this ladder, e.g. for HTTP ETags: equal ladders get the
+        # same fingerprint in every process, and any change to a player or match gives a new one.
+        digest = hashlib.sha1()
+        digest.update(json.dumps([[p.name, p.rank, p.age, p.email] for p in self.players]).encode())
+        self.matches.update_digest(digest)
+        return digest.hexdigest()
+
+    def _check_mutable(self):
+        if self.frozen:
+            raise RuntimeError("This ladder is a published snapshot; load a fresh one to change it")
+
+    def _position(self, player):
+        # Binary search on rank, then walk over ties to find this exact player
+        lo, hi = 0, len(self._ranked)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._ranked[mid].rank < player.rank:
+                lo = mid + 1
+            else:
+                hi = mid
+        while self._ranked[lo] is not player:
+            lo += 1
+        return lo
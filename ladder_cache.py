@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+
+
+class LadderCache:
+    # Keeps the last loaded ladder in memory so read routes don't hit the Sheets API on every request.
+    # - A snapshot younger than `ttl` seconds is served as is.
+    # - A snapshot older than `ttl` but younger than `max_stale` is still served, while a background
+    #   thread reloads it (so readers never wait on Google once the cache is warm).
+    # - Anything older, or a cache that was invalidated by one of our own writes, is reloaded inline.
+    # When `check_version` is given (a cheap call returning the storage's current version), an
+    # expired snapshot is first revalidated: if the storage still has the version the snapshot was
+    # loaded at (`ladder.version`), it is kept without downloading and parsing everything again.
+    # Snapshots are still reloaded in full at least every `max_age` seconds.
+    # Snapshots are frozen (see Ladder.freeze) before they are published, and the current one is
+    # swapped in by a single reference assignment, so readers never wait for a load and never see a
+    # ladder that is being loaded or changed; they only take the lock for a moment to count the hit.
+    # `sequence` maps a ladder version to a number that grows with every write (None if unknown), so
+    # that writers finishing out of order, or a load that started before a write, can't replace a
+    # snapshot with an older one. A ladder without a version (loaded while writes were still
+    # pending, see WriteBehindStorage.load) never replaces one that has a version either.
+    def __init__(self, loader, ttl=30, max_stale=300, check_version=None, max_age=600, sequence=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.check_version = check_version
+        self.max_age = max_age
+        self.sequence = sequence
+        self.version = 0  # Bumped on every invalidation and every newly installed snapshot
+        self._entry = (None, 0.0)  # (ladder, when it was last loaded or revalidated), replaced as a whole
+        self._fetched_at = 0.0  # When the snapshot was last loaded in full
+        self._after_fork()
+        os.register_at_fork(after_in_child=self._after_fork)
+        self._counters = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'revalidations': 0,
+            'invalidations': 0,
+            'outdated_puts': 0,
+            'outdated_loads': 0,
+        }
+
+    def get(self):
+        ladder, loaded_at = self._entry
+        age = time.monotonic() - loaded_at
+
+        if ladder is not None and age < self.ttl:
+            self._count('hits')
+            return ladder
+
+        if ladder is not None and age < self.max_stale:
+            self._count('stale_hits')
+            self._refresh_in_background()
+            return ladder
+
+        self._count('misses')
+        return self._load(ladder)
+
+    def put(self, ladder):
+        # Publish a ladder we just wrote ourselves, so readers see it without reloading. Another
+        # writer may already have published a later version, which includes this write too.
+        ladder.freeze(self._entry[0])
+        with self._lock:
+            if self._is_older(ladder, self._entry[0]):
+                self._counters['outdated_puts'] += 1
+                return False
+            self.version += 1
+            self._fetched_at = time.monotonic()
+            self._entry = (ladder, self._fetched_at)
+            self._counters['invalidations'] += 1
+        return True
+
+    def invalidate(self):
+        with self._lock:
+            self._entry = (None, 0.0)
+            self.version += 1
+            self._counters['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['version'] = self.version
+            ladder, loaded_at = self._entry
+            stats['age'] = round(time.monotonic() - loaded_at, 3) if ladder is not None else None
+            stats['ttl'] = self.ttl
+        return stats
+
+    def _is_older(self, ladder, current):
+        if current is None or current.version is None:
+            return False
+        if ladder.version is None:
+            return True
+        if self.sequence is None:
+            return False
+        new, published = self.sequence(ladder.version), self.sequence(current.version)
+        return new is not None and published is not None and new < published
+
+    def _after_fork(self):
+        # A forked child gets a copy of the lock (maybe held) but not the refresh thread
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _load(self, current=None):
+        with self._lock:
+            version = self.version
+        ladder = self._fetch(current)
+        if not self._install(ladder, version, fetched=ladder is not current):
+            kept = self._entry[0]
+            if kept is not None and self._is_older(ladder, kept):
+                return kept
+        return ladder
+
+    def _fetch(self, current):
+        # Reload the ladder, unless the storage reports that `current` is still up to date
+        if (current is not None and self.check_version is not None and current.version is not None
+                and time.monotonic() - self._fetched_at < self.max_age):
+            if self.check_version() == current.version:
+                self._count('revalidations')
+                return current
+        return self.loader()
+
+    def _install(self, ladder, version, fetched=True):
+        # Only publish the snapshot if nobody invalidated the cache while we were loading,
+        # otherwise a reload that started before a write could overwrite the fresher state.
+        ladder.freeze(self._entry[0])
+        with self._lock:
+            if version != self.version:
+                return False
+            now = time.monotonic()
+            current = self._entry[0]
+            if fetched and self._is_older(ladder, current):
+                # Keep the newer snapshot; it counts as checked, so the next load waits for the TTL
+                self._counters['outdated_loads'] += 1
+                self._entry = (current, now)
+                return False
+            if fetched:
+                # A revalidated snapshot keeps its version, it is the same ladder
+                self.version += 1
+                self._fetched_at = now
+            self._entry = (ladder, now)
+            return True
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            version = self.version
+            current = self._entry[0]
+        thread = threading.Thread(target=self._refresh, args=(version, current), daemon=True)
+        thread.start()
+
+    def _refresh(self, version, current):
+        try:
+            ladder = self._fetch(current)
+            fetched = ladder is not current
+            if self._install(ladder, version, fetched) and fetched:
+                self._count('refreshes')
+        except Exception as e:
+            self._count('refresh_errors')
+            print(f"Background ladder refresh failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
@@ -0,0 +1,63 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class PageCache:
+    # Rendered pages, least recently used first, bounded by their total size in bytes. Keys include
+    # the fingerprint of the ladder snapshot a page was rendered from (see Ladder.freeze), so a page
+    # is never served for another version of the ladder; pages of older snapshots are simply never
+    # asked for again and get evicted.
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._pages = OrderedDict()
+        self._size = 0
+        self._after_fork()
+        os.register_at_fork(after_in_child=self._after_fork)
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    def get(self, key, render):
+        # The page for `key` as bytes, calling `render()` (which returns a str or bytes) on a miss
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                self._counters['hits'] += 1
+                return page
+            self._counters['misses'] += 1
+
+        # Rendered outside the lock; two threads missing the same page may both render it
+        page = render()
+        if isinstance(page, str):
+            page = page.encode()
+        self.put(key, page)
+        return page
+
+    def put(self, key, page):
+        if len(page) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._pages.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._pages[key] = page
+            self._size += len(page)
+            while self._size > self.max_bytes:
+                _, evicted = self._pages.popitem(last=False)
+                self._size -= len(evicted)
+                self._counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['pages'] = len(self._pages)
+            stats['bytes'] = self._size
+            stats['max_bytes'] = self.max_bytes
+        return stats
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
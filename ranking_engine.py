@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+from array import array
+from collections import namedtuple
+
+
+class RankingEngine:
+    # Replays matches through the ladder rules to recompute the ranking from the match history.
+    # The ranking is a permutation of player ids kept in two arrays, `order` (position -> player
+    # id) and `position` (player id -> position), so an upset only shifts the handful of slots
+    # between the old and new positions instead of re-sorting or inserting into a list of players.
+    # Ranks are positions + 1; the rules are those of Ladder.record_match for a ladder ranked 1..n.
+    def __init__(self, order, min_rank_difference=6, downrank_rank_difference=3, uprank_rank_difference=3):
+        self.order = array('i', order)
+        self.position = array('i', [0]) * len(self.order)
+        for i, player_id in enumerate(self.order):
+            self.position[player_id] = i
+        self.min_rank_difference = min_rank_difference
+        self.downrank_rank_difference = downrank_rank_difference
+        self.uprank_rank_difference = uprank_rank_difference
+        self.replayed = 0  # Number of matches of the log applied so far
+
+    @classmethod
+    def for_ladder(cls, ladder, order):
+        # Engine with the rules of `ladder`, starting from `order` (player ids, best first)
+        return cls(order, ladder.min_rank_difference, ladder.downrank_rank_difference, ladder.uprank_rank_difference)
+
+    def rules(self):
+        return [self.min_rank_difference, self.downrank_rank_difference, self.uprank_rank_difference]
+
+    def apply(self, player1, player2, winner):
+        # Apply one match between player ids. Returns how many rank positions the players moved in
+        # total (0 if the ranking is unchanged).
+        order, position = self.order, self.position
+        index1, index2 = position[player1], position[player2]
+        if index1 < index2:
+            better, worse, better_index, worse_index = player1, player2, index1, index2
+        else:
+            better, worse, better_index, worse_index = player2, player1, index2, index1
+
+        if winner != worse:
+            return 0
+
+        if worse_index - better_index <= self.min_rank_difference:
+            order[better_index], order[worse_index] = worse, better
+            position[worse], position[better] = better_index, worse_index
+            return 2 * (worse_index - better_index)
+
+        # The winner moves up, then the loser moves down, shifting only the slots in between
+        new_winner_index = max(0, worse_index - self.uprank_rank_difference)
+        order[new_winner_index + 1:worse_index + 1] = order[new_winner_index:worse_index]
+        order[new_winner_index] = worse
+
+        loser_index = better_index + 1 if new_winner_index <= better_index else better_index
+        new_loser_index = min(len(order) - 1, loser_index + self.downrank_rank_difference)
+        order[loser_index:new_loser_index] = order[loser_index + 1:new_loser_index + 1]
+        order[new_loser_index] = better
+
+        moved = 0
+        for i in range(min(new_winner_index, better_index), max(worse_index, new_loser_index) + 1):
+            moved += abs(i - position[order[i]])
+            position[order[i]] = i
+        return moved
+
+    def replay(self, matches, stop=None):
+        # Apply the matches of a MatchLog from the first one not replayed yet up to `stop`.
+        # Matches whose winner is not one of the players never change the ranking.
+        stop = len(matches) if stop is None else stop
+        player1, player2, winner = matches.columns()
+        apply = self.apply
+        for i in range(self.replayed, stop):
+            if winner[i] >= 0:
+                apply(player1[i], player2[i], winner[i])
+        self.replayed = max(self.replayed, stop)
+        return self
+
+    def ranks(self):
+        # Rank of every player, indexed by player id
+        return [i + 1 for i in self.position]
+
+
+def history_digest(ladder, count):
+    # Fingerprint of the first `count` matches; a checkpoint is only reused while the history it
+    # replayed is unchanged. It uses player names, not ids, which change when the sheet is reordered.
+    player1, player2, winner = ladder.matches.columns()
+    timestamps = ladder.matches.timestamps()
+    names = [player.name for player in ladder.players]
+    digest = hashlib.sha256()
+    for i in range(count):
+        winner_name = names[winner[i]] if winner[i] >= 0 else ''
+        digest.update(f"{names[player1[i]]}\0{names[player2[i]]}\0{winner_name}\0{timestamps[i]}\n".encode())
+    return digest.hexdigest()
+
+
+# A ranking known to be right after the first `matches` matches of the history, as player ids (best
+# first). Replays start from one: the stored data doesn't say in which order players joined (the
+# Ranking sheet is rewritten in rank order), so it can't be replayed from the very first match.
+Baseline = namedtuple('Baseline', ['order', 'matches'])
+
+
+class MissingBaseline(Exception):
+    # There is no baseline that applies to the ladder, so its history can't be replayed
+    pass
+
+
+def save_baseline(ladder, path):
+    # Trust the stored ranking of `ladder` as it is now. The checkpoint file keeps it next to the
+    # progress of the last replay, which starts over from here.
+    order = [player.name for player in ladder.get_ranking()]
+    digest = history_digest(ladder, len(ladder.matches))
+    _write_checkpoint(path, {
+        'baseline': {'matches': len(ladder.matches), 'digest': digest, 'order': order},
+        'rules': _ladder_rules(ladder),
+        'matches': len(ladder.matches),
+        'digest': digest,
+        'order': order,
+    })
+
+
+def load_baseline(ladder, path):
+    # The baseline saved at `path` (see save_baseline), raises MissingBaseline when there is none or
+    # the matches it was saved after have changed since. Players who joined after it start at the
+    # bottom, in the order of their rows.
+    checkpoint = _read_checkpoint(path)
+    baseline = checkpoint.get('baseline') if checkpoint else None
+    if baseline is None:
+        raise MissingBaseline(f"No baseline ranking in {path}")
+    if (baseline['matches'] > len(ladder.matches)
+            or baseline['digest'] != history_digest(ladder, baseline['matches'])):
+        raise MissingBaseline(f"The matches before the baseline ranking in {path} have changed")
+    order = _player_ids(ladder, baseline['order'])
+    if order is None:
+        raise MissingBaseline(f"Players of the baseline ranking in {path} are missing")
+    return Baseline(order, baseline['matches'])
+
+
+def load_checkpoint(ladder, path, baseline):
+    # Engine at the progress of the last replay saved at `path`, if it applies to this ladder (same
+    # rules, and the replayed part of the history is unchanged), otherwise at `baseline`
+    checkpoint = _read_checkpoint(path)
+    if (checkpoint is not None and checkpoint.get('rules') == _ladder_rules(ladder)
+            and baseline.matches <= checkpoint['matches'] <= len(ladder.matches)
+            and checkpoint['digest'] == history_digest(ladder, checkpoint['matches'])):
+        order = _player_ids(ladder, checkpoint['order'])
+        if order is not None:
+            engine = RankingEngine.for_ladder(ladder, order)
+            engine.replayed = checkpoint['matches']
+            return engine
+
+    engine = RankingEngine.for_ladder(ladder, baseline.order)
+    engine.replayed = baseline.matches
+    return engine
+
+
+def save_checkpoint(engine, ladder, path):
+    checkpoint = _read_checkpoint(path) or {}
+    checkpoint.update({
+        'rules': engine.rules(),
+        'matches': engine.replayed,
+        'digest': history_digest(ladder, engine.replayed),
+        'order': [ladder.players[player_id].name for player_id in engine.order],
+    })
+    _write_checkpoint(path, checkpoint)
+
+
+def verify(ladder, checkpoint_path, reset=False):
+    # Replays the history of `ladder` from its baseline (or, unless `reset`, from the last
+    # checkpoint) and compares the result with its stored ranks. Returns the engine, a list of
+    # (player, stored rank, replayed rank) for every player whose rank differs, and the indexes of
+    # the replayed matches whose winner is not one of their players, which can't change the ranking.
+    baseline = load_baseline(ladder, checkpoint_path)
+    if reset:
+        engine = RankingEngine.for_ladder(ladder, baseline.order)
+        engine.replayed = baseline.matches
+    else:
+        engine = load_checkpoint(ladder, checkpoint_path, baseline)
+    engine.replay(ladder.matches)
+    save_checkpoint(engine, ladder, checkpoint_path)
+
+    ranks = engine.ranks()
+    mismatches = [(player, player.rank, ranks[player.id])
+                  for player in ladder.get_ranking() if player.rank != ranks[player.id]]
+    return engine, mismatches, ladder.matches.unresolved(baseline.matches)
+
+
+def _ladder_rules(ladder):
+    return [ladder.min_rank_difference, ladder.downrank_rank_difference, ladder.uprank_rank_difference]
+
+
+def _player_ids(ladder, names):
+    # Ids of the named players, followed by those of any other player; None if a name is unknown
+    players = [ladder.get_player(name) for name in names]
+    if None in players:
+        return None
+    order = [player.id for player in players]
+    known = set(order)
+    return order + [player_id for player_id in range(len(ladder.players)) if player_id not in known]
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_checkpoint(path, checkpoint):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)  # Never leave a half-written checkpoint behind
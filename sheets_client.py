@@ -0,0 +1,140 @@
+import functools
+import json
+import os
+import queue
+import threading
+
+import google_auth_httplib2
+import httplib2
+from googleapiclient.discovery import Resource, build_from_document, fix_method_name
+from googleapiclient.discovery_cache import get_static_doc
+
+from startup_report import phase
+
+# The Sheets discovery document shipped with googleapiclient, parsed once at import time. With
+# `gunicorn --preload` this happens in the master process and workers share it copy-on-write.
+with phase('parse discovery document'):
+    DISCOVERY_DOCUMENT = json.loads(get_static_doc('sheets', 'v4'))
+
+
+class SheetsClient:
+    # Google Sheets API client that can be used from several threads and worker processes.
+    # - Nothing is set up until the first request: `load_credentials` is called and the service is
+    #   built lazily, once per process, so importing the app (e.g. in the gunicorn master before it
+    #   forks) never opens a connection that would then be shared by the workers.
+    # - httplib2.Http is not thread-safe, so instead of the single transport the service would use,
+    #   each request checks an authorized Http out of a pool and returns it when it is done, while
+    #   the credentials and the service are shared. Background refreshes and page warming run in
+    #   short-lived threads, which thereby reuse open connections instead of a new TLS handshake.
+    #   At most `pool_size` idle transports are kept.
+    # Requests must be run with `client.execute(request)`.
+    def __init__(self, load_credentials, pool_size=8):
+        self.load_credentials = load_credentials
+        self.pool_size = pool_size
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def values(self):
+        # The spreadsheets.values resource, which has all the methods the app uses
+        self._setup()
+        return self._values
+
+    def execute(self, request):
+        self._setup()
+        try:
+            http = self._pool.get_nowait()  # The most recently used one, whose connection is most likely still open
+        except queue.Empty:
+            http = google_auth_httplib2.AuthorizedHttp(self._credentials, http=httplib2.Http())
+            self._created += 1
+        try:
+            return request.execute(http=http)
+        finally:
+            try:
+                self._pool.put_nowait(http)
+            except queue.Full:
+                http.http.close()
+
+    def stats(self):
+        return {'transports_created': self._created, 'transports_idle': self._pool.qsize()}
+
+    def _setup(self):
+        if self._values is not None:
+            return
+        with self._lock:
+            if self._values is None:
+                with phase('credentials'):
+                    self._credentials = self.load_credentials()
+                with phase('build service'):
+                    service = build_from_document(DISCOVERY_DOCUMENT, credentials=self._credentials)
+                    self._values = LazyResource.from_resource(service).spreadsheets().values()
+
+    def _reset(self):
+        # Also called in a freshly forked child: drop anything that belongs to the parent process
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._values = None
+        self._pool = queue.LifoQueue(self.pool_size)
+        self._created = 0
+
+
+class LazyResource(Resource):
+    # googleapiclient Resource that only creates an API method (or nested resource) the first time
+    # it is accessed. The stock Resource creates every method of a collection up front, with its
+    # generated docstring, which takes a few hundred milliseconds for spreadsheets.values() alone
+    # although the app only ever calls a handful of them.
+    @classmethod
+    def from_resource(cls, resource):
+        return cls(
+            http=resource._http,
+            baseUrl=resource._baseUrl,
+            model=resource._model,
+            requestBuilder=resource._requestBuilder,
+            developerKey=resource._developerKey,
+            resourceDesc=resource._resourceDesc,
+            rootDesc=resource._rootDesc,
+            schema=resource._schema,
+            universe_domain=resource._universe_domain,
+        )
+
+    def _set_service_methods(self):
+        # Nothing is created up front, see __getattr__
+        pass
+
+    def __getattr__(self, name):
+        # Only called for attributes that don't exist yet; what is created here is stored on the
+        # instance, exactly where Resource would have put it, so it is only created once.
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        for method_name, method_desc in self._resourceDesc.get('methods', {}).items():
+            if name in (fix_method_name(method_name), fix_method_name(method_name + '_media'),
+                        fix_method_name(method_name + '_next')):
+                only_this_method = {'methods': {method_name: method_desc}}
+                self._add_basic_methods(only_this_method, self._rootDesc, self._schema)
+                self._add_next_methods(only_this_method, self._schema)
+                break
+        else:
+            for resource_name, resource_desc in self._resourceDesc.get('resources', {}).items():
+                if name == fix_method_name(resource_name):
+                    self._set_dynamic_attr(name, functools.partial(self._nested_resource, resource_desc))
+                    break
+            else:
+                if name == 'new_batch_http_request' and self._resourceDesc is self._rootDesc:
+                    self._add_basic_methods(self._rootDesc, self._rootDesc, self._schema)
+
+        if name not in self.__dict__:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        return self.__dict__[name]
+
+    def _nested_resource(self, resource_desc):
+        return LazyResource(
+            http=self._http,
+            baseUrl=self._baseUrl,
+            model=self._model,
+            requestBuilder=self._requestBuilder,
+            developerKey=self._developerKey,
+            resourceDesc=resource_desc,
+            rootDesc=self._rootDesc,
+            schema=self._schema,
+            universe_domain=self._universe_domain,
+        )
@@ -0,0 +1,103 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+from ranking_engine import RankingEngine
+
+# What-if simulation of the ladder rules: the real match history since the baseline ranking (see
+# ranking_engine.Baseline) is replayed from that ranking under every given set of rules, to compare
+# how much each one shuffles the ladder and which standings it ends with. Replays are independent,
+# so they are spread over a process pool; small sweeps run in this process, where starting the pool
+# would cost more.
+
+Rules = namedtuple('Rules', ['min_rank_difference', 'downrank_rank_difference', 'uprank_rank_difference'])
+
+# Below this many replayed matches in total, `simulate` doesn't start a process pool
+POOL_THRESHOLD = 200000
+
+
+def rule_grid(min_rank_differences, downrank_rank_differences, uprank_rank_differences):
+    # Every combination of the given values
+    return [Rules(*values) for values in product(min_rank_differences, downrank_rank_differences, uprank_rank_differences)]
+
+
+def parse_values(text):
+    # "4-8" -> [4, 5, 6, 7, 8], "1,3,5" -> [1, 3, 5], "6" -> [6]
+    values = []
+    for part in text.split(','):
+        start, _, stop = part.partition('-')
+        values.extend(range(int(start), int(stop or start) + 1))
+    return values
+
+
+def ladder_rules(ladder):
+    return Rules(ladder.min_rank_difference, ladder.downrank_rank_difference, ladder.uprank_rank_difference)
+
+
+def simulate(ladder, rules, baseline, processes=None):
+    # Replays the matches of `ladder` after `baseline` under each Rules in `rules`, starting from the
+    # baseline ranking. Matches whose winner is not one of their players can't be replayed under any
+    # rules (see MatchLog.unresolved). Returns one result per Rules, in the same order:
+    # {'rules', 'changes' (matches that changed the ranking), 'moves' (rank positions moved in
+    #  total), 'moves_per_match', 'distance' (sum of the differences between the simulated and
+    #  the current ranks; 0 under the current rules when the stored ranks are right),
+    #  'standings' (players from first to last)}
+    start = baseline.matches
+    player1, player2, winner = ladder.matches.columns()
+    history = (list(baseline.order), player1[start:].tolist(), player2[start:].tolist(), winner[start:].tolist())
+    replayed = len(ladder.matches) - start
+
+    if processes is None:
+        processes = 1 if len(rules) * replayed < POOL_THRESHOLD else os.cpu_count()
+    if processes <= 1 or len(rules) <= 1:
+        orders = _replay_all(history, rules)
+    else:
+        # A few chunks per process keeps the pool busy without pickling the results one by one
+        size = max(1, len(rules) // (processes * 4))
+        chunks = [rules[i:i + size] for i in range(0, len(rules), size)]
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(history,)) as pool:
+            orders = [result for chunk in pool.map(_replay_chunk, chunks) for result in chunk]
+
+    results = []
+    for rule, (order, changes, moves) in zip(rules, orders):
+        standings = [ladder.players[player_id] for player_id in order]
+        results.append({
+            'rules': rule,
+            'changes': changes,
+            'moves': moves,
+            'moves_per_match': moves / replayed if replayed else 0.0,
+            'distance': sum(abs(rank - player.rank) for rank, player in enumerate(standings, start=1)),
+            'standings': standings,
+        })
+    return results
+
+
+def _replay_all(history, rules):
+    order, player1, player2, winner = history
+    results = []
+    for rule in rules:
+        engine = RankingEngine(order, *rule)
+        apply = engine.apply
+        changes = moves = 0
+        for i in range(len(winner)):
+            if winner[i] >= 0:
+                moved = apply(player1[i], player2[i], winner[i])
+                if moved:
+                    changes += 1
+                    moves += moved
+        results.append((engine.order.tolist(), changes, moves))
+    return results
+
+
+_worker_history = None
+
+
+def _init_worker(history):
+    # Runs once in every pool process, so the history is only sent to each process once
+    global _worker_history
+    _worker_history = history
+
+
+def _replay_chunk(rules):
+    return _replay_all(_worker_history, rules)
@@ -0,0 +1,116 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+# Seconds spent in the named startup phases of this process, recorded with `phase`
+PHASES = {}
+
+
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASES[name] = PHASES.get(name, 0.0) + time.perf_counter() - started
+
+
+# Run in a fresh interpreter (with -X importtime) so nothing is imported or cached beforehand.
+# Setting up the Sheets client is lazy, so it is triggered explicitly to time credentials and build().
+CHILD_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+import startup_report
+error = None
+try:
+    app.sheets_client.values()
+except Exception as e:
+    error = f"{type(e).__name__}: {e}"
+print(json.dumps({
+    'import app': imported - started,
+    'phases': startup_report.PHASES,
+    'sheets_client_error': error,
+}))
+"""
+
+
+def parse_importtime(stderr):
+    # Lines look like "import time:  self [us] | cumulative | imported package" (nesting = indent)
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # Header line
+        modules.append({
+            'module': fields[2].strip(),
+            'self': int(fields[0]) / 1e6,
+            'cumulative': int(fields[1]) / 1e6,
+        })
+    return modules
+
+
+def collect():
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD_SCRIPT],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        output = [line for line in result.stderr.splitlines() if not line.startswith('import time:')]
+        raise RuntimeError("Starting the app failed:\n" + '\n'.join(output[-20:]))
+
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    modules = parse_importtime(result.stderr)
+    packages = {}
+    for module in modules:
+        package = module['module'].split('.')[0]
+        packages[package] = packages.get(package, 0.0) + module['self']
+
+    report['python'] = sys.version.split()[0]
+    report['modules'] = sorted(modules, key=lambda m: m['self'], reverse=True)
+    report['packages'] = sorted(({'package': p, 'self': t} for p, t in packages.items()),
+                                key=lambda p: p['self'], reverse=True)
+    return report
+
+
+def format_report(report, top=15):
+    ms = lambda seconds: f"{seconds * 1000:9.1f} ms"
+    lines = [f"Startup report (Python {report['python']})", '']
+    lines.append(f"  {'import app':<40}{ms(report['import app'])}")
+    for name, seconds in sorted(report['phases'].items(), key=lambda item: item[1], reverse=True):
+        lines.append(f"  {name:<40}{ms(seconds)}")
+    if report['sheets_client_error']:
+        lines.append(f"  (Sheets client not set up: {report['sheets_client_error']})")
+
+    lines += ['', f"Import time by top-level package (top {top})"]
+    for package in report['packages'][:top]:
+        lines.append(f"  {package['package']:<40}{ms(package['self'])}")
+
+    lines += ['', f"Slowest modules (top {top})", f"  {'':<40}{'self':>12}{'cumulative':>13}"]
+    for module in report['modules'][:top]:
+        lines.append(f"  {module['module']:<40}{ms(module['self'])}  {ms(module['cumulative'])}")
+    return '\n'.join(lines)
+
+
+def main():
+    import argparse  # Only needed when run as a script, not when the app imports `phase`
+
+    parser = argparse.ArgumentParser(description="Report where the app spends its cold start time.")
+    parser.add_argument('--top', type=int, default=15, help="number of packages and modules to list")
+    parser.add_argument('--json', action='store_true', help="print the full report as JSON, e.g. to compare releases")
+    args = parser.parse_args()
+
+    report = collect()
+    print(json.dumps(report, indent=2) if args.json else format_report(report, args.top))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,705 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing, contextmanager
+from datetime import datetime
+
+from ladder import TIME_FORMAT, Ladder, Match, Player
+
+# Ranges of the ladder in the spreadsheet
+RANGE_NAME_RANKING = 'Ranking!A1:D'
+RANGE_NAME_MATCHES = 'Matches!A1:F'
+# Rank cell of a single player, addressed by the player's row in the Ranking sheet
+RANGE_NAME_RANK_CELL = 'Ranking!B{row}'
+# Cell holding a token that is rewritten after every write, so readers can tell cheaply whether
+# the ladder changed. It sits next to the Ranking table rather than in a tab of its own, so it
+# can be read in the same request as the ladder and exists in every copy of the spreadsheet.
+RANGE_NAME_VERSION = 'Ranking!F1'
+
+RANKING_HEADER = ['Name', 'Rank', 'Age', 'Email']
+MATCHES_HEADER = ['Player 1', 'Player 2', 'Winner', 'Sets', 'Time', 'Comment']
+
+
+def player_to_row(player):
+    return [player.name, player.rank, player.age, player.email]
+
+
+def match_to_row(match):
+    return [match.player1.name, match.player2.name,
+            match.result.name if isinstance(match.result, Player) else match.result,
+            str(match.sets), match.time.strftime(TIME_FORMAT), match.comment]
+
+
+def pad(row, width):
+    # The Sheets API leaves out empty cells at the end of a row (e.g. a match without a comment)
+    return list(row[:width]) + [''] * (width - len(row))
+
+
+def build_ladder(player_rows, match_rows):
+    # player_rows: [name, rank, age, email, row in the Ranking sheet]
+    # match_rows: [player 1, player 2, winner, sets, time, comment], in the order they were played
+    ladder = Ladder()
+    for name, rank, age, email, row in player_rows:
+        ladder.add_player(Player(name, int(rank), int(age), email, row=row))
+
+    for row in match_rows:
+        row = pad(row, 6)
+        player1 = ladder.get_player(row[0])
+        player2 = ladder.get_player(row[1])
+        winner = row[2]
+        sets = row[3]
+        time = datetime.strptime(row[4], TIME_FORMAT)  # Parsed once here, kept as a datetime
+        comment = row[5]
+        ladder.matches.append(Match(player1, player2, winner, sets, time, comment))
+
+    return ladder
+
+
+class SheetsStorage:
+    # Reads and writes the ladder directly in the Google spreadsheet, through a SheetsClient.
+    def __init__(self, client, spreadsheet_id):
+        self.client = client
+        self.spreadsheet_id = spreadsheet_id
+
+    def load(self):
+        # Fetch both tabs and the version in a single round trip instead of one values().get() per range
+        request = self.client.values().batchGet(
+            spreadsheetId=self.spreadsheet_id,
+            ranges=[RANGE_NAME_RANKING, RANGE_NAME_MATCHES, RANGE_NAME_VERSION]
+        )
+        result = self.client.execute(request)
+        ranking_result, matches_result, version_result = result.get('valueRanges', [{}, {}, {}])
+        ranking_values = ranking_result.get('values', [])
+        matches_values = matches_result.get('values', [])
+        ladder = build_ladder(
+            [pad(row, 4) + [row_number] for row_number, row in enumerate(ranking_values[1:], start=2)],
+            matches_values[1:]
+        )
+        ladder.version = cell_value(version_result)
+        return ladder
+
+    def version(self):
+        # The version token alone: one tiny request instead of downloading the whole ladder
+        request = self.client.values().get(spreadsheetId=self.spreadsheet_id, range=RANGE_NAME_VERSION)
+        return cell_value(self.client.execute(request))
+
+    def save_match(self, match, changes):
+        # A new match is a single appended row, and only the rank cells of the players moved by
+        # Ladder.record_match are rewritten, so a write never grows with the ladder or the history.
+        self.append_rows(RANGE_NAME_MATCHES, [match_to_row(match)])
+        self.write_ranks([[change.player.row, change.new_rank] for change in changes])
+
+    def add_player(self, player):
+        self.append_rows(RANGE_NAME_RANKING, [player_to_row(player)])
+
+    # Primitive writes. They only take plain values so WriteQueue can replay them.
+
+    def append_rows(self, range_name, rows):
+        request = self.client.values().append(
+            spreadsheetId=self.spreadsheet_id,
+            range=range_name,
+            valueInputOption="RAW",
+            insertDataOption="INSERT_ROWS",
+            body={"values": rows}
+        )
+        self.client.execute(request)
+
+    def write_ranks(self, ranks):
+        # ranks: [[row in the Ranking sheet, new rank], ...]
+        data = [
+            {"range": RANGE_NAME_RANK_CELL.format(row=row), "values": [[rank]]}
+            for row, rank in ranks
+        ]
+        if not data:
+            return
+
+        request = self.client.values().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={"valueInputOption": "RAW", "data": data}
+        )
+        self.client.execute(request)
+
+    def bump_version(self):
+        # Any new value will do, readers only compare it with the one they loaded
+        request = self.client.values().update(
+            spreadsheetId=self.spreadsheet_id,
+            range=RANGE_NAME_VERSION,
+            valueInputOption="RAW",
+            body={"values": [[uuid.uuid4().hex]]}
+        )
+        self.client.execute(request)
+
+    def write_tables(self, ranking_rows, match_rows):
+        # Clear both tabs first, so rows beyond the new tables (e.g. after an import) don't linger
+        request = self.client.values().batchClear(
+            spreadsheetId=self.spreadsheet_id,
+            body={"ranges": [RANGE_NAME_RANKING, RANGE_NAME_MATCHES]}
+        )
+        self.client.execute(request)
+
+        request = self.client.values().update(
+            spreadsheetId=self.spreadsheet_id,
+            range=RANGE_NAME_RANKING,
+            valueInputOption="RAW",
+            body={"values": [RANKING_HEADER] + ranking_rows}
+        )
+        self.client.execute(request)
+
+        request = self.client.values().update(
+            spreadsheetId=self.spreadsheet_id,
+            range=RANGE_NAME_MATCHES,
+            valueInputOption="RAW",
+            body={"values": [MATCHES_HEADER] + match_rows}
+        )
+        self.client.execute(request)
+
+
+def cell_value(value_range):
+    # Value of a single-cell range returned by the Sheets API, '' when the cell is empty
+    values = value_range.get('values', [])
+    return values[0][0] if values and values[0] else ''
+
+
+# Version counter, bumped by every write (see `compare_and_bump`)
+META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO meta (id) VALUES (1);
+"""
+
+LADDER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    rank INTEGER NOT NULL,
+    age INTEGER NOT NULL,
+    email TEXT NOT NULL,
+    sheet_row INTEGER
+);
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    player1 TEXT NOT NULL,
+    player2 TEXT NOT NULL,
+    winner TEXT,
+    sets TEXT,
+    time TEXT NOT NULL,
+    comment TEXT
+);
+""" + META_SCHEMA
+
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    args TEXT NOT NULL,
+    enqueued_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS mirror_lease (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    owner TEXT,
+    expires REAL NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO mirror_lease (id) VALUES (1);
+""" + META_SCHEMA
+
+
+def connect(path):
+    # Autocommit connection; transactions are opened explicitly by `transaction`
+    return sqlite3.connect(path, timeout=30, isolation_level=None)
+
+
+@contextmanager
+def transaction(path, immediate=False):
+    conn = connect(path)
+    try:
+        conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+
+def create_schema(path, schema):
+    with closing(connect(path)) as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(schema)
+
+
+class VersionConflict(Exception):
+    # The ladder was changed by someone else since it was loaded; reload it and apply the write again
+    pass
+
+
+class StorageUnavailable(Exception):
+    # The spreadsheet can't be reached, so nothing can be saved until it can; retrying at once won't help
+    pass
+
+
+def compare_and_bump(conn, expected_version):
+    # Compare-and-swap on the meta version inside an open write transaction: bumps the version and
+    # returns the new one only if it is still `expected_version`, raises VersionConflict otherwise
+    # (the exception rolls the whole transaction back).
+    cursor = conn.execute('UPDATE meta SET version = version + 1 WHERE id = 1 AND version = ?',
+                          (expected_version,))
+    if cursor.rowcount != 1:
+        raise VersionConflict("The ladder was changed by another write")
+    return expected_version + 1
+
+
+class WriteBehindStorage:
+    # Spreadsheet storage whose writes are acknowledged as soon as they are durably queued in a
+    # local WriteQueue, instead of waiting on the Sheets API; the queue is flushed in the background.
+    # A ladder's version is "<queue version>:<spreadsheet version token>": the queue database counts
+    # the writes of every worker process on this machine, the token catches writes from elsewhere.
+    def __init__(self, sheets, queue_path, flush_attempts=10, flush_wait=0.1):
+        self.sheets = sheets
+        self.queue = WriteQueue(queue_path, sheets)
+        self.flush_attempts = flush_attempts
+        self.flush_wait = flush_wait
+        self.last_flush_error = None  # Why the last load couldn't send the queued writes, if it couldn't
+
+    def load(self):
+        # Queued writes are not in the spreadsheet yet, so send them before reading it back. When
+        # another process is still sending them, wait for it. A ladder read while writes were still
+        # pending may miss some of them; it gets no version, so nothing can be saved on top of it.
+        queue_version = None
+        for attempt in range(self.flush_attempts):
+            try:
+                self.queue.flush()
+            except Exception as e:
+                print(f"Sheets write queue flush failed: {e}")
+                self.last_flush_error = e
+                break
+            self.last_flush_error = None
+            pending, version = self._queue_state()
+            if not pending:
+                queue_version = version
+                break
+            time.sleep(self.flush_wait)
+
+        try:
+            ladder = self.sheets.load()
+        except Exception as e:
+            raise StorageUnavailable(f"The spreadsheet could not be read: {e}") from e
+        ladder.version = f"{queue_version}:{ladder.version}" if queue_version is not None else None
+        return ladder
+
+    def version(self):
+        _, queue_version = self._queue_state()
+        return f"{queue_version}:{self.sheets.version()}"
+
+    def sequence(self, version):
+        # Writes made through this machine's queue are counted by its part of the version
+        return int(version.split(':', 1)[0]) if version else None
+
+    def save_match(self, match, changes, expected_version):
+        queue_version, token = self._check_version(expected_version)
+        with self.queue.transaction() as conn:
+            queue_version = compare_and_bump(conn, queue_version)
+            self.queue.enqueue(conn, 'append_rows', [RANGE_NAME_MATCHES, [match_to_row(match)]])
+            if changes:
+                self.queue.enqueue(conn, 'write_ranks', [[[change.player.row, change.new_rank] for change in changes]])
+        self.queue.notify()
+        return f"{queue_version}:{token}"
+
+    def save_ranks(self, changes, expected_version):
+        queue_version, token = self._check_version(expected_version)
+        with self.queue.transaction() as conn:
+            queue_version = compare_and_bump(conn, queue_version)
+            self.queue.enqueue(conn, 'write_ranks', [[[change.player.row, change.new_rank] for change in changes]])
+        self.queue.notify()
+        return f"{queue_version}:{token}"
+
+    def add_player(self, player, expected_version):
+        queue_version, token = self._check_version(expected_version)
+        with self.queue.transaction() as conn:
+            queue_version = compare_and_bump(conn, queue_version)
+            self.queue.enqueue(conn, 'append_rows', [RANGE_NAME_RANKING, [player_to_row(player)]])
+        self.queue.notify()
+        return f"{queue_version}:{token}"
+
+    def compact(self, ladder):
+        # The rewrite goes through the queue like any other write: after the writes queued before
+        # it (their rank cells use the old rows), and only if nothing was written since `ladder` was
+        # loaded. Writes computed from the old rows fail the version check and are redone on top.
+        queue_version, token = self._check_version(ladder.version)
+        with self.queue.transaction() as conn:
+            queue_version = compare_and_bump(conn, queue_version)
+            self._enqueue_tables(conn, ladder)
+        self.queue.flush()  # Returns at once if another process is sending, which sends it too
+        return f"{queue_version}:{token}"
+
+    def replace(self, ladder):
+        # The spreadsheet is the whole ladder, so replacing it is the same full rewrite, whatever
+        # the current version (`ladder` doesn't come from this storage)
+        with self.queue.transaction() as conn:
+            conn.execute('UPDATE meta SET version = version + 1')
+            self._enqueue_tables(conn, ladder)
+        self.queue.flush()
+
+    def stats(self):
+        return {'backend': 'sheets', 'write_queue': self.queue.stats()}
+
+    def _enqueue_tables(self, conn, ladder):
+        ranking = ladder.get_ranking()
+        self.queue.enqueue(conn, 'write_tables', [[player_to_row(p) for p in ranking],
+                                                  [match_to_row(m) for m in ladder.matches]])
+
+    def _queue_state(self):
+        # (number of pending writes, queue version), read together
+        with transaction(self.queue.path) as conn:
+            return conn.execute('SELECT (SELECT COUNT(*) FROM outbox), version FROM meta').fetchone()
+
+    def _check_version(self, expected_version):
+        # The queue version is checked atomically by compare_and_bump. The spreadsheet has no
+        # conditional writes, so its token is only compared here, just before the write is queued.
+        if expected_version is None:
+            if self.last_flush_error is not None:
+                raise StorageUnavailable(f"Queued writes could not be sent to the spreadsheet: {self.last_flush_error}")
+            raise VersionConflict("The ladder was loaded while writes were still pending")
+        queue_version, token = expected_version.split(':', 1)
+        try:
+            current_token = self.sheets.version()
+        except Exception as e:
+            raise StorageUnavailable(f"The spreadsheet version could not be read: {e}") from e
+        if current_token != token:
+            raise VersionConflict("The spreadsheet was changed by another writer")
+        return int(queue_version), token
+
+
+class SQLiteStorage:
+    # Keeps the ladder in a local SQLite database, which is the source of truth. When `sheets`
+    # (a SheetsStorage) is given, the database is seeded from the spreadsheet on first use, and
+    # every write is queued in the same transaction in a WriteQueue living in the same database,
+    # which copies it to the spreadsheet in the background, so requests never wait on Google.
+    def __init__(self, path, sheets=None):
+        self.path = path
+        self.sheets = sheets
+        create_schema(path, LADDER_SCHEMA)
+        self.queue = WriteQueue(path, sheets) if sheets is not None else None
+        self._seeded = False
+
+    def load(self):
+        if not self._seeded:
+            self._seed()
+        if self.queue is not None:
+            self.queue.start()
+
+        with transaction(self.path) as conn:
+            version = conn.execute('SELECT version FROM meta').fetchone()[0]
+            player_rows = conn.execute(
+                'SELECT name, rank, age, email, sheet_row FROM players ORDER BY id').fetchall()
+            match_rows = conn.execute(
+                'SELECT player1, player2, winner, sets, time, comment FROM matches ORDER BY id').fetchall()
+        ladder = build_ladder(player_rows, match_rows)
+        ladder.version = version
+        return ladder
+
+    def version(self):
+        # Bumped in the same transaction as every change to the ladder
+        with closing(connect(self.path)) as conn:
+            return conn.execute('SELECT version FROM meta').fetchone()[0]
+
+    def sequence(self, version):
+        return version
+
+    def save_match(self, match, changes, expected_version):
+        with transaction(self.path, immediate=True) as conn:
+            version = compare_and_bump(conn, expected_version)
+            conn.execute('INSERT INTO matches (player1, player2, winner, sets, time, comment) VALUES (?, ?, ?, ?, ?, ?)',
+                         match_to_row(match))
+            conn.executemany('UPDATE players SET rank = ? WHERE name = ?',
+                             [(change.new_rank, change.player.name) for change in changes])
+            self._enqueue(conn, 'append_rows', [RANGE_NAME_MATCHES, [match_to_row(match)]])
+            if changes:
+                self._enqueue(conn, 'write_ranks', [[[change.player.row, change.new_rank] for change in changes]])
+        self._notify_queue()
+        return version
+
+    def save_ranks(self, changes, expected_version):
+        with transaction(self.path, immediate=True) as conn:
+            version = compare_and_bump(conn, expected_version)
+            conn.executemany('UPDATE players SET rank = ? WHERE name = ?',
+                             [(change.new_rank, change.player.name) for change in changes])
+            self._enqueue(conn, 'write_ranks', [[[change.player.row, change.new_rank] for change in changes]])
+        self._notify_queue()
+        return version
+
+    def add_player(self, player, expected_version):
+        with transaction(self.path, immediate=True) as conn:
+            version = compare_and_bump(conn, expected_version)
+            # New players are appended right below the last row of the Ranking sheet
+            player.row = conn.execute('SELECT COALESCE(MAX(sheet_row), 1) + 1 FROM players').fetchone()[0]
+            conn.execute('INSERT INTO players (name, rank, age, email, sheet_row) VALUES (?, ?, ?, ?, ?)',
+                         player_to_row(player) + [player.row])
+            self._enqueue(conn, 'append_rows', [RANGE_NAME_RANKING, [player_to_row(player)]])
+        self._notify_queue()
+        return version
+
+    def compact(self, ladder):
+        # The database is always compact; this rewrites the spreadsheet from it, in ranking order.
+        # Players get new rows, so writes computed from `ladder` or earlier must not follow it.
+        ranking = ladder.get_ranking()
+        with transaction(self.path, immediate=True) as conn:
+            version = compare_and_bump(conn, ladder.version)
+            conn.executemany('UPDATE players SET sheet_row = ? WHERE name = ?',
+                             [(i + 2, player.name) for i, player in enumerate(ranking)])
+            self._enqueue(conn, 'write_tables', [[player_to_row(p) for p in ranking],
+                                                 [match_to_row(m) for m in ladder.matches]])
+        if self.queue is not None:
+            self.queue.flush()
+        return version
+
+    def replace(self, ladder):
+        # Swap the whole ladder for `ladder` (e.g. imported from a workbook) and rewrite the spreadsheet
+        ranking = ladder.get_ranking()
+        with transaction(self.path, immediate=True) as conn:
+            conn.execute('DELETE FROM players')
+            conn.execute('DELETE FROM matches')
+            conn.executemany('INSERT INTO players (name, rank, age, email, sheet_row) VALUES (?, ?, ?, ?, ?)',
+                             [player_to_row(p) + [i + 2] for i, p in enumerate(ranking)])
+            conn.executemany('INSERT INTO matches (player1, player2, winner, sets, time, comment) VALUES (?, ?, ?, ?, ?, ?)',
+                             [match_to_row(m) for m in ladder.matches])
+            conn.execute('UPDATE meta SET version = version + 1')
+            self._enqueue(conn, 'write_tables', [[player_to_row(p) for p in ranking],
+                                                 [match_to_row(m) for m in ladder.matches]])
+        self._seeded = True
+        if self.queue is not None:
+            self.queue.flush()
+
+    def stats(self):
+        return {'backend': 'sqlite', 'write_queue': self.queue.stats() if self.queue is not None else None}
+
+    def _seed(self):
+        # Import the spreadsheet into an empty database, so switching backends keeps the ladder
+        with transaction(self.path, immediate=True) as conn:
+            empty = conn.execute('SELECT COUNT(*) FROM players').fetchone()[0] == 0
+            if empty and self.sheets is not None:
+                ladder = self.sheets.load()
+                # Names are unique in the database. If the sheet lists a name twice, the first row is
+                # kept, the one Ladder.get_player (and so every match of that name) refers to.
+                players = []
+                for player in ladder.players:
+                    if ladder.get_player(player.name) is player:
+                        players.append(player)
+                    else:
+                        print(f"Skipped duplicate player {player.name} in row {player.row} of the Ranking sheet")
+                conn.executemany('INSERT INTO players (name, rank, age, email, sheet_row) VALUES (?, ?, ?, ?, ?)',
+                                 [player_to_row(p) + [p.row] for p in players])
+                conn.executemany('INSERT INTO matches (player1, player2, winner, sets, time, comment) VALUES (?, ?, ?, ?, ?, ?)',
+                                 [match_to_row(m) for m in ladder.matches])
+                conn.execute('UPDATE meta SET version = version + 1')
+        self._seeded = True
+
+    def _enqueue(self, conn, op, args):
+        if self.queue is not None:
+            self.queue.enqueue(conn, op, args)
+
+    def _notify_queue(self):
+        if self.queue is not None:
+            self.queue.notify()
+
+
+class WriteQueue:
+    # Durable queue of spreadsheet writes (the `outbox` table of a SQLite database), replayed to a
+    # SheetsStorage by a background thread. Pending operations are coalesced when they are sent:
+    # rank cell updates become a single batchUpdate (the latest rank of each cell wins) and rows
+    # appended to the same tab become a single append. Several worker processes may share the
+    # database, so a lease in the `mirror_lease` table makes sure only one of them sends at a time.
+    OPERATIONS = ('append_rows', 'write_ranks', 'write_tables')
+
+    def __init__(self, path, sheets, poll_interval=5, lease_time=60):
+        self.path = path
+        self.sheets = sheets
+        self.poll_interval = poll_interval
+        self.lease_time = lease_time
+        create_schema(path, QUEUE_SCHEMA)
+        self._after_fork()
+        os.register_at_fork(after_in_child=self._after_fork)
+        # The flusher is a daemon thread, which dies with the process: send what is left on the way
+        # out (e.g. when gunicorn stops a worker on a restart or deploy), in every worker process
+        atexit.register(self._flush_at_exit)
+        self._metrics = {
+            'flushes': 0,
+            'flushed_operations': 0,
+            'sheets_requests': 0,
+            'failures': 0,
+            'last_error': None,
+            'last_flush_seconds': None,  # How long the last flush took
+            'last_flush_lag': None,  # Age of the oldest operation sent by the last flush
+        }
+
+    def transaction(self):
+        return transaction(self.path, immediate=True)
+
+    def enqueue(self, conn, op, args):
+        # `conn` is an open transaction on the queue database, so the write is queued atomically
+        conn.execute('INSERT INTO outbox (op, args, enqueued_at) VALUES (?, ?, ?)',
+                     (op, json.dumps(args), time.time()))
+
+    def start(self):
+        # Threads don't survive a fork, so every worker process starts its own on first use
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        self.start()
+        self._wakeup.set()
+
+    def flush(self):
+        # Send everything that is queued; returns the number of queued operations sent to Sheets
+        with self._flush_lock:
+            if not self._acquire_lease():
+                return 0
+            started = time.monotonic()
+            try:
+                with transaction(self.path) as conn:
+                    entries = conn.execute('SELECT id, op, args, enqueued_at FROM outbox ORDER BY id').fetchall()
+                if not entries:
+                    return 0
+                oldest = min(entry[3] for entry in entries)
+                sent = 0
+                try:
+                    for op, args, entry_ids in coalesce(entries):
+                        getattr(self.sheets, op)(*args)
+                        with self.transaction() as conn:
+                            conn.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in entry_ids])
+                            self._renew_lease(conn)
+                        sent += len(entry_ids)
+                        self._count('sheets_requests')
+                finally:
+                    if sent:
+                        # Tell readers in other processes that the spreadsheet changed
+                        self.sheets.bump_version()
+                        self._count('sheets_requests')
+                with self._lock:
+                    self._metrics['flushes'] += 1
+                    self._metrics['flushed_operations'] += sent
+                    self._metrics['last_flush_seconds'] = round(time.monotonic() - started, 3)
+                    self._metrics['last_flush_lag'] = round(time.time() - oldest, 3)
+                return sent
+            except Exception as e:
+                with self._lock:
+                    self._metrics['failures'] += 1
+                    self._metrics['last_error'] = str(e)
+                raise
+            finally:
+                self._release_lease()
+
+    def stats(self):
+        with transaction(self.path) as conn:
+            depth, oldest = conn.execute('SELECT COUNT(*), MIN(enqueued_at) FROM outbox').fetchone()
+        with self._lock:
+            stats = dict(self._metrics)
+        stats['depth'] = depth
+        stats['oldest_pending_age'] = round(time.time() - oldest, 3) if oldest else None
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._metrics[name] += 1
+
+    def _after_fork(self):
+        # Called in __init__ and in every forked child, which must not share the parent's lease
+        self.owner = uuid.uuid4().hex
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # The operations stay queued and are retried on the next wake-up
+                print(f"Sheets write queue flush failed: {e}")
+
+    def _flush_at_exit(self, timeout=20):
+        # Another worker may hold the lease, also shutting down: wait until the queue is empty
+        # (it sends our writes too) or give up before the platform kills the process
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                self.flush()
+                with transaction(self.path) as conn:
+                    pending = conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+                if not pending or time.monotonic() > deadline:
+                    break
+                time.sleep(0.2)
+        except Exception as e:
+            print(f"Sheets write queue flush at exit failed: {e}")
+            pending = None
+        if pending != 0:
+            print(f"Sheets writes are still queued in {self.path}")
+
+    def _acquire_lease(self):
+        now = time.time()
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                'UPDATE mirror_lease SET owner = ?, expires = ? WHERE id = 1 AND (owner = ? OR owner IS NULL OR expires < ?)',
+                (self.owner, now + self.lease_time, self.owner, now))
+            return cursor.rowcount == 1
+
+    def _renew_lease(self, conn):
+        conn.execute('UPDATE mirror_lease SET expires = ? WHERE id = 1 AND owner = ?',
+                     (time.time() + self.lease_time, self.owner))
+
+    def _release_lease(self):
+        with self.transaction() as conn:
+            conn.execute('UPDATE mirror_lease SET owner = NULL, expires = 0 WHERE id = 1 AND owner = ?', (self.owner,))
+
+
+def coalesce(entries):
+    # Merges queued (id, op, args, enqueued_at) entries into as few Sheets requests as possible.
+    # Operations on different tabs are independent, so an operation may be merged into an earlier
+    # one of the same kind as long as nothing in between touches the same tab.
+    # Returns [(op, args, [ids of the merged entries]), ...] in the order they must be sent.
+    merged = []
+    for entry_id, op, args, _ in entries:
+        if op not in WriteQueue.OPERATIONS:
+            raise ValueError(f"Unknown write queue operation: {op}")
+        args = json.loads(args)
+        tabs = operation_tabs(op, args)
+        target = None
+        for candidate in reversed(merged):
+            if candidate[0] == op and (op != 'append_rows' or candidate[1][0] == args[0]):
+                target = candidate
+                break
+            if candidate[3] & tabs:
+                break
+        if target is None or op == 'write_tables':
+            merged.append([op, args, [entry_id], tabs])
+        elif op == 'append_rows':
+            target[1][1].extend(args[1])
+            target[2].append(entry_id)
+        else:
+            # Later ranks overwrite earlier ones for the same cell
+            ranks = dict(map(tuple, target[1][0]))
+            ranks.update(map(tuple, args[0]))
+            target[1][0] = [list(item) for item in ranks.items()]
+            target[2].append(entry_id)
+    return [(op, args, entry_ids) for op, args, entry_ids, _ in merged]
+
+
+def operation_tabs(op, args):
+    if op == 'append_rows':
+        return {args[0].partition('!')[0]}
+    if op == 'write_ranks':
+        return {RANGE_NAME_RANKING.partition('!')[0]}
+    return {RANGE_NAME_RANKING.partition('!')[0], RANGE_NAME_MATCHES.partition('!')[0]}